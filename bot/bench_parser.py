@@ -0,0 +1,107 @@
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from parsering import parse_google_sheet, parse_skills_data, split_grid
+from sheets_fake import FakeSheetsService, generate_spreadsheet, load_fixture
+
+SHEET_URL = 'https://docs.google.com/spreadsheets/d/benchmark'
+
+
+def measure(func, repeat):
+    # Лучшее время из repeat запусков и пиковая память одного запуска
+    if repeat < 1:
+        raise ValueError(f"repeat must be at least 1, got {repeat}")
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def run_benchmarks(spreadsheet, repeat):
+    rows = sum(len(tab['values']) - 1 for tab in spreadsheet.values())
+    cells = sum(len(tab['values']) * len(tab['values'][0]) for tab in spreadsheet.values())
+    service = FakeSheetsService(spreadsheet)
+    grid = service.spreadsheet(None, True)
+    tabs = [split_grid(sheet) for sheet in grid['sheets']]
+
+    cases = {
+        'parse_skills_data': lambda: [parse_skills_data(values, formatting) for values, formatting in tabs],
+        'parse_google_sheet (batched)': lambda: parse_google_sheet(SHEET_URL, None, service_factory=service),
+        'parse_google_sheet (per tab)': lambda: parse_google_sheet(SHEET_URL, None, batched=False,
+                                                                   service_factory=service),
+    }
+    results = {}
+    for name, func in cases.items():
+        service.calls = 0
+        elapsed, peak, _ = measure(func, repeat)
+        results[name] = {
+            'seconds': elapsed,
+            'rows_per_second': rows / elapsed,
+            'cells_per_second': cells / elapsed,
+            'peak_mb': peak / 2 ** 20,
+            'api_calls': service.calls // (repeat + 1)
+        }
+    return results
+
+
+def print_results(results):
+    print(f"{'benchmark':<32}{'seconds':>10}{'rows/s':>12}{'cells/s':>14}{'peak MB':>10}{'API calls':>11}")
+    for name, result in results.items():
+        print(f"{name:<32}{result['seconds']:>10.3f}{result['rows_per_second']:>12.0f}"
+              f"{result['cells_per_second']:>14.0f}{result['peak_mb']:>10.1f}{result['api_calls']:>11}")
+
+
+def compare(results, baseline_file, tolerance):
+    with open(baseline_file, encoding='utf-8') as file:
+        baseline = json.load(file)
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result['seconds'] > baseline[name]['seconds'] * (1 + tolerance):
+            regressions.append(f"{name}: {baseline[name]['seconds']:.3f}s -> {result['seconds']:.3f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк импорта Google Sheets на локальной заглушке API')
+    parser.add_argument('--tabs', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--columns', type=int, default=200, help='количество столбцов с датами')
+    parser.add_argument('--fixture', help='JSON с таблицей вместо сгенерированной')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='сохранить результаты в JSON как эталон')
+    parser.add_argument('--compare', help='сравнить с эталоном и завершиться с кодом 1 при замедлении')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое замедление, доля')
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('--repeat должен быть не меньше 1')
+
+    if args.fixture:
+        spreadsheet = load_fixture(args.fixture)
+    else:
+        spreadsheet = generate_spreadsheet(args.tabs, args.rows, args.columns)
+    results = run_benchmarks(spreadsheet, args.repeat)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
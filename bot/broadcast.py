@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, NetworkError, RetryAfter, TelegramAPIError, \
+    UserDeactivated
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и не чаще одного в секунду в один чат
+GLOBAL_RATE = 25
+PER_CHAT_INTERVAL = 1
+CONCURRENCY = 10
+REPORT_INTERVAL = 5
+MESSAGE_LIMIT = 4096
+
+# Результат отправки: RETRY - временная ошибка, FAILED - Telegram отклонил сообщение,
+# UNREACHABLE - бот заблокирован, чата нет или аккаунт удален (повторять бессмысленно)
+SENT = 'sent'
+RETRY = 'retry'
+FAILED = 'failed'
+UNREACHABLE = 'unreachable'
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    # Делит текст на части не длиннее limit по границам строк; слишком длинная строка режется как есть
+    chunks = []
+    current = ''
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            chunks.append(current)
+            current = ''
+        current += line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # После RetryAfter весь бот молчит указанное время
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.updated = time.monotonic()
+
+
+class Broadcaster:
+    def __init__(self, bot, rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL, concurrency=CONCURRENCY):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.concurrency = concurrency
+        self._chat_next_send = {}
+        self._tasks = set()
+
+    async def _wait_for_chat(self, chat_id):
+        now = time.monotonic()
+        next_send = self._chat_next_send.get(chat_id, now)
+        self._chat_next_send[chat_id] = max(now, next_send) + self.per_chat_interval
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+        if len(self._chat_next_send) > 10000:
+            self._chat_next_send = {chat: t for chat, t in self._chat_next_send.items() if t > now}
+
+    async def send(self, chat_id, text, retries=3):
+        # RETRY, если все попытки закончились временной ошибкой
+        for _ in range(retries):
+            status = await self.attempt(chat_id, text)
+            if status != RETRY:
+                return status
+        return RETRY
+
+    async def attempt(self, chat_id, text):
+        # Одна попытка отправки через общие лимиты
+        await self._wait_for_chat(chat_id)
+        await self.bucket.acquire()
+        try:
+            await self.bot.send_message(chat_id, text)
+            return SENT
+        except RetryAfter as e:
+            # Следующий acquire подождет, пока корзина не восстановится после паузы
+            logging.warning(f"Flood control, waiting {e.timeout} s")
+            self.bucket.pause(e.timeout)
+            return RETRY
+        except (BotBlocked, ChatNotFound, UserDeactivated):
+            return UNREACHABLE
+        except NetworkError as e:
+            logging.warning(f"Network error sending message to {chat_id}: {e}")
+            return RETRY
+        except TelegramAPIError as e:
+            logging.warning(f"Failed to send message to {chat_id}: {e}")
+            return FAILED
+
+    def start(self, sender_id, user_ids, text):
+        task = asyncio.create_task(self.broadcast(sender_id, user_ids, text))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def broadcast(self, sender_id, user_ids, text):
+        # Обычно выполняется фоновой задачей (start), результат которой никто не ждет, поэтому ошибки
+        # логируются здесь и, если можно, сообщаются отправителю
+        user_ids = list(user_ids)
+        total = len(user_ids)
+        try:
+            status = await self.bot.send_message(sender_id, f"Рассылка запущена: 0 из {total}")
+        except Exception as e:
+            # Рассылка идет и без сообщения о ходе
+            logging.warning(f"Failed to send broadcast status to {sender_id}: {e!r}")
+            status = None
+        last_report = time.monotonic()
+
+        async def progress(done):
+            nonlocal last_report
+            if time.monotonic() - last_report >= REPORT_INTERVAL:
+                last_report = time.monotonic()
+                await self._report(status, f"Рассылка: {done} из {total}")
+
+        try:
+            statuses = await self.send_many(user_ids, text, progress)
+        except Exception:
+            logging.exception(f"Broadcast from {sender_id} failed")
+            await self._report(status, "Рассылка прервана из-за ошибки")
+            return None
+        sent = sum(status == SENT for status in statuses.values())
+        stats = {'sent': sent, 'failed': total - sent}
+        await self._report(status, f"Уведомление отправлено! Доставлено: {stats['sent']}, "
+                                   f"не доставлено: {stats['failed']}")
+        logging.info(f"Broadcast from {sender_id} finished: {stats}")
+        return stats
+
+    async def send_many(self, user_ids, text, progress=None):
+        # Один текст многим получателям через общие лимиты; возвращает {user_id: результат отправки}
+        queue = asyncio.Queue()
+        for user_id in user_ids:
+            queue.put_nowait(user_id)
+        statuses = {}
+        done = 0
+
+        async def worker():
+            nonlocal done
+            while not queue.empty():
+                user_id = queue.get_nowait()
+                statuses[user_id] = await self.send(user_id, text)
+                done += 1
+                if progress:
+                    await progress(done)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, queue.qsize()))))
+        return statuses
+
+    async def _report(self, status, text):
+        if status is None:
+            return
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logging.warning(f"Failed to update broadcast status: {e!r}")
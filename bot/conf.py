@@ -1,2 +1,18 @@
 API_TOKEN = 'BOT:TOKEN'
 CREDENTIALS_FILE = 'bot\your_credential.json'
+SCHEDULER_MODE = 'interval'  # 'interval' - опрос раз в 30 секунд, 'deadline' - таймер до ближайшего напоминания
+DB_MODE = 'default'  # 'default' или 'wal' - WAL и групповой коммит записей в одном потоке
+SHEETS_RESYNC_MINUTES = 60  # как часто перечитывать Google Sheets курсов
+SKILLS_DIGEST_MINUTES = 5  # как часто рассылать подборки навыков новой недели
+METRICS_PORT = None  # порт для /metrics (формат Prometheus) на 127.0.0.1, None - не запускать
+DB_PROFILE = False  # профилирование методов Database: /dbstats и лог медленных запросов
+SLOW_QUERY_MS = 100  # порог медленного запроса для лога, мс
+BOT_MODE = 'polling'  # 'polling' или 'webhook' - aiohttp-сервер за reverse proxy
+WEBHOOK_URL = 'https://example.com'  # публичный адрес, на который Telegram шлет апдейты (без пути)
+WEBHOOK_PATH = '/bot'
+WEBHOOK_SECRET = None  # секрет из заголовка X-Telegram-Bot-Api-Secret-Token: A-Z, a-z, 0-9, _ и -
+WEBAPP_HOST = '127.0.0.1'
+WEBAPP_PORT = 8080
+REPLICAS = 1  # сколько экземпляров бота обрабатывают апдейты; больше 1 - кеши FSM, профилей и навыков выключаются
+LEADER_LEASE_SECONDS = 30  # аренда лидера планировщика: за это время задачи перейдут к другому экземпляру
+OUTBOX_RETENTION_DAYS = 30  # сколько дней хранить обработанные записи очереди напоминаний
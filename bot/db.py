@@ -1,12 +1,167 @@
+import asyncio
+import functools
+import itertools
+import logging
+import queue
+import re
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+WEEKDAYS = {
+    "Понедельник": 0,
+    "Вторник": 1,
+    "Среда": 2,
+    "Четверг": 3,
+    "Пятница": 4,
+    "Суббота": 5,
+    "Воскресение": 6,
+    "Воскресенье": 6
+}
+MINUTES_IN_WEEK = 7 * 24 * 60
+
+# Миграции схемы по порядку; номер последней примененной хранится в PRAGMA user_version
+MIGRATIONS = [
+    (1, '_migration_minute_of_week'),
+    (2, '_migration_hot_path_indexes'),
+    (3, '_migration_sheet_modified_time'),
+    (4, '_migration_unique_skills'),
+    (5, '_migration_appointments_user_course'),
+    (6, '_migration_search_index'),
+    (7, '_migration_course_weeks'),
+    (8, '_migration_skills_notifications_week'),
+    (9, '_migration_calendar_weeks'),
+    (10, '_migration_leases'),
+    (11, '_migration_notification_outbox'),
+    (12, '_migration_outbox_expiry'),
+    (13, '_migration_enrollment_owner')
+]
+
+SKILLS_CHUNK_SIZE = 500
+HEADER_DATE_FORMATS = ('%d.%m.%Y', '%d.%m.%y', '%Y-%m-%d')
+WEEK_HEADER = re.compile(r'(\d+)(?:\s*нед\w*\.?)?', re.IGNORECASE)
+
+# Таблицы с полнотекстовым индексом `<таблица>_search` и индексируемые столбцы
+SEARCH_INDEXES = {
+    'users': ('nickname', 'user_id'),
+    'courses': ('course_name',)
+}
+
+
+def parse_week_header(text):
+    # Заголовок столбца в таблице курса: номер недели ("3", "3 неделя") или дата ("02.09.2024")
+    text = (text or '').strip()
+    match = WEEK_HEADER.fullmatch(text)
+    if match:
+        return int(match.group(1))
+    for date_format in HEADER_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            pass
+    return None
+
+
+def week_ordinals(headers):
+    # Заголовки -> номера недель от начала курса (первая неделя - 1) и дата понедельника первой недели.
+    # Даты считаются от самой ранней даты курса, номера недель берутся как есть
+    parsed = {header: parse_week_header(header) for header in headers}
+    dates = [value for value in parsed.values() if isinstance(value, date)]
+    course_start = min(dates) - timedelta(days=min(dates).weekday()) if dates else None
+    weeks = {}
+    for header, value in parsed.items():
+        if isinstance(value, date):
+            weeks[header] = (value - course_start).days // 7 + 1
+        else:
+            weeks[header] = value
+    return weeks, course_start
+
+
+def search_query(text):
+    # Каждое слово запроса ищется как префикс; кавычки экранируются, чтобы ввод не ломал синтаксис FTS5
+    words = text.split()
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+
+WRITE_METHODS = {
+    'add_user', 'set_nickname', 'set_signup', 'set_rules', 'add_course', 'add_skills', 'enroll_user',
+    'add_appointment', 'submit_homework', 'add_schedule', 'delete_enrollment', 'set_week_override',
+    'update_notification_log', 'record_skills_notifications', 'sync_skills', 'rebuild_course_weeks',
+    'enqueue_notifications', 'acquire_lease', 'release_lease', 'complete_outbox', 'purge_outbox'
+}
+
+# (за сколько минут до встречи, тип уведомления)
+NOTIFICATION_TYPES = [
+    (6 * 24 * 60, "6_days"),
+    (4 * 24 * 60, "4_days"),
+    (24 * 60, "1_day"),
+    (60, "1_hour"),
+    (-60, "1_hour_after")
+]
+
+
+def notification_expiry(notification_type, fire_time):
+    # Напоминание имеет смысл, пока не прошла четверть его упреждения (не больше суток):
+    # "1_hour" - 15 минут, "1_day" - 6 часов, "6_days" - сутки. Возвращает время в секундах эпохи
+    offset = dict((name, offset) for offset, name in NOTIFICATION_TYPES)[notification_type]
+    return fire_time.timestamp() + min(abs(offset) * 60 / 4, 24 * 3600)
+
+
+def minute_of_week(weekday, time):
+    day = WEEKDAYS.get(weekday.strip().capitalize())
+    if day is None:
+        return None
+    try:
+        parsed = datetime.strptime(time.strip(), '%H:%M')
+    except ValueError:
+        return None
+    return day * 24 * 60 + parsed.hour * 60 + parsed.minute
 
 class Database:
-    def __init__(self, db_file):
+    def __init__(self, db_file, create=True):
         self.connection = sqlite3.connect(db_file)
         self.connection.row_factory = sqlite3.Row
         self.cursor = self.connection.cursor()
-        self.create_tables()
+        self.in_batch = False
+        if create:
+            self.create_tables()
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        # Внутри run_batch транзакцией управляет поток записи
+        if self.in_batch:
+            yield
+        else:
+            with self.connection:
+                yield
+
+    def run_batch(self, calls):
+        # Все записи пачки - одна транзакция; ошибка в одной откатывает только ее savepoint
+        results = []
+        self.in_batch = True
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            for name, args, kwargs in calls:
+                self.cursor.execute("SAVEPOINT write")
+                try:
+                    results.append((True, getattr(self, name)(*args, **kwargs)))
+                    self.cursor.execute("RELEASE write")
+                except Exception as e:
+                    self.cursor.execute("ROLLBACK TO write")
+                    self.cursor.execute("RELEASE write")
+                    results.append((False, e))
+            self.connection.commit()
+        except sqlite3.Error:
+            self.connection.rollback()
+            raise
+        finally:
+            self.in_batch = False
+        return results
 
     def create_tables(self):
         with self.connection:
@@ -74,6 +229,7 @@ class Database:
                 `course_id` INTEGER NOT NULL,
                 `weekday` TEXT NOT NULL,
                 `time` TEXT NOT NULL,
+                `minute_of_week` INTEGER,
                 FOREIGN KEY (`teacher_id`) REFERENCES `users` (`user_id`),
                 FOREIGN KEY (`user_id`) REFERENCES `users` (`user_id`),
                 FOREIGN KEY (`course_id`) REFERENCES `courses` (`id`)
@@ -101,12 +257,217 @@ class Database:
             );
         """)
             self.connection.commit()
+        self.migrate()
+
+    def migrate(self):
+        for version, migration in MIGRATIONS:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            try:
+                if self.cursor.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    self.connection.rollback()
+                    continue
+                getattr(self, migration)()
+                self.cursor.execute(f"PRAGMA user_version = {version}")
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+            logging.info(f"Database migrated to version {version} ({migration})")
+
+    def schema_version(self):
+        return self.cursor.execute("PRAGMA user_version").fetchone()[0]
+
+    def _migration_minute_of_week(self):
+        if self._add_column('appointments', 'minute_of_week', 'INTEGER'):
+            rows = self.cursor.execute("SELECT `id`, `weekday`, `time` FROM `appointments`").fetchall()
+            self.cursor.executemany("UPDATE `appointments` SET `minute_of_week` = ? WHERE `id` = ?",
+                                    [(minute_of_week(row['weekday'], row['time']), row['id']) for row in rows])
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS `idx_appointments_minute_of_week`
+            ON `appointments` (`minute_of_week`)
+        """)
+
+    def _migration_hot_path_indexes(self):
+        # Повторные записи на один и тот же курс оставляем в одном экземпляре
+        self.cursor.execute("""
+            DELETE FROM `enrollments`
+            WHERE `id` NOT IN (SELECT MIN(`id`) FROM `enrollments` GROUP BY `user_id`, `course_id`)
+        """)
+        self.cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS `idx_enrollments_user_course`
+            ON `enrollments` (`user_id`, `course_id`)
+        """)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS `idx_enrollments_course` ON `enrollments` (`course_id`)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS `idx_appointments_user` ON `appointments` (`user_id`)")
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS `idx_homework_course_submitted`
+            ON `homework` (`course_id`, `submitted_at`)
+        """)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS `idx_skills_course` ON `skills` (`course_id`)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS `idx_courses_owner` ON `courses` (`owner_id`)")
+
+    def _migration_sheet_modified_time(self):
+        self._add_column('courses', 'sheet_modified_time', 'TEXT')
+
+    def _migration_unique_skills(self):
+        self.cursor.execute("""
+            DELETE FROM `skills`
+            WHERE `id` NOT IN (SELECT MAX(`id`) FROM `skills` GROUP BY `course_id`, `skill`)
+        """)
+        self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS `idx_skills_course_skill` ON `skills` (`course_id`, `skill`)")
+
+    def _migration_appointments_user_course(self):
+        # Составной индекс покрывает и поиск по одному user_id, поэтому старый индекс не нужен
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS `idx_appointments_user_course`
+            ON `appointments` (`user_id`, `course_id`)
+        """)
+        self.cursor.execute("DROP INDEX IF EXISTS `idx_appointments_user`")
+
+    def _migration_search_index(self):
+        # Полнотекстовый поиск по нику/ID пользователя и названию курса: FTS5 поверх самих таблиц,
+        # индексы поддерживаются триггерами
+        for table, columns in SEARCH_INDEXES.items():
+            column_list = ', '.join(f'`{column}`' for column in columns)
+            old_values = ', '.join(f'old.`{column}`' for column in columns)
+            new_values = ', '.join(f'new.`{column}`' for column in columns)
+            self.cursor.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS `{table}_search`
+                USING fts5({column_list}, content='{table}', content_rowid='id', prefix='1 2 3')
+            """)
+            self.cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS `{table}_search_insert` AFTER INSERT ON `{table}` BEGIN
+                    INSERT INTO `{table}_search` (rowid, {column_list}) VALUES (new.`id`, {new_values});
+                END
+            """)
+            self.cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS `{table}_search_delete` AFTER DELETE ON `{table}` BEGIN
+                    INSERT INTO `{table}_search` (`{table}_search`, rowid, {column_list})
+                    VALUES ('delete', old.`id`, {old_values});
+                END
+            """)
+            self.cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS `{table}_search_update` AFTER UPDATE OF {column_list} ON `{table}` BEGIN
+                    INSERT INTO `{table}_search` (`{table}_search`, rowid, {column_list})
+                    VALUES ('delete', old.`id`, {old_values});
+                    INSERT INTO `{table}_search` (rowid, {column_list}) VALUES (new.`id`, {new_values});
+                END
+            """)
+            self.cursor.execute(f"INSERT INTO `{table}_search` (`{table}_search`) VALUES ('rebuild')")
+
+    def _migration_course_weeks(self):
+        self._add_column('skills', 'start_week', 'INTEGER')
+        self._add_column('skills', 'end_week', 'INTEGER')
+        self._add_column('courses', 'start_date', 'TEXT')
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS `course_week_skills` (
+                `course_id` INTEGER NOT NULL,
+                `week` INTEGER NOT NULL,
+                `skill_id` INTEGER NOT NULL,
+                `skill` TEXT NOT NULL,
+                `link` TEXT,
+                PRIMARY KEY (`course_id`, `week`, `skill_id`)
+            ) WITHOUT ROWID
+        """)
+        for course in self.cursor.execute("SELECT DISTINCT `course_id` FROM `skills`").fetchall():
+            self._rebuild_course_weeks(course['course_id'])
+
+    def _migration_skills_notifications_week(self):
+        # Подборка навыков отправляется раз за неделю курса; старые записи (без недели) в проверке не участвуют
+        self._add_column('skills_notifications', 'week', 'INTEGER')
+        self.cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS `idx_skills_notifications_user_course_week`
+            ON `skills_notifications` (`user_id`, `course_id`, `week`)
+        """)
+
+    def _migration_calendar_weeks(self):
+        # Неделя курса считается по календарю, а не счетчиком week_number (он больше не обновляется).
+        # Существующим записям enrolled_at подбирается так, чтобы текущая неделя осталась прежней
+        if self._add_column('enrollments', 'enrolled_at', 'TEXT'):
+            self.cursor.execute("""
+                UPDATE `enrollments`
+                SET `enrolled_at` = date('now', 'localtime', '-6 days', 'weekday 1',
+                                         printf('%+d days', (1 - COALESCE(`week_number`, 0)) * 7))
+            """)
+        self._add_column('enrollments', 'week_override', 'INTEGER')
+        # Начало отсчета - понедельник первой недели курса из таблицы (courses.start_date),
+        # если в таблице номера недель, а не даты, - понедельник недели записи на курс
+        self.cursor.execute("""
+            CREATE VIEW IF NOT EXISTS `enrollment_weeks` AS
+            SELECT e.`id`, e.`user_id`, e.`course_id`,
+                   COALESCE(e.`week_override`, CASE WHEN days < 0 THEN 0 ELSE days / 7 + 1 END) AS `week`
+            FROM (
+                SELECT e.*, CAST(julianday('now', 'localtime', 'start of day') - julianday(
+                    COALESCE(c.`start_date`, date(e.`enrolled_at`, '-6 days', 'weekday 1'))) AS INTEGER) AS days
+                FROM `enrollments` e
+                JOIN `courses` c ON c.`id` = e.`course_id`
+            ) e
+        """)
+
+    def _migration_leases(self):
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS `leases` (
+                `name` TEXT PRIMARY KEY,
+                `holder` TEXT NOT NULL,
+                `expires_at` REAL NOT NULL
+            )
+        """)
+
+    def _migration_notification_outbox(self):
+        # Напоминания, ожидающие отправки: status - 'pending', 'sent' или 'failed'
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS `notification_outbox` (
+                `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+                `user_id` INTEGER NOT NULL,
+                `course_id` INTEGER,
+                `notification_type` TEXT NOT NULL,
+                `text` TEXT NOT NULL,
+                `status` TEXT NOT NULL DEFAULT 'pending',
+                `attempts` INTEGER NOT NULL DEFAULT 0,
+                `next_attempt_at` REAL NOT NULL,
+                `last_error` TEXT,
+                `created_at` TEXT NOT NULL,
+                `sent_at` TEXT
+            )
+        """)
+        # Диспетчер читает только ожидающие записи, отправленные в индекс не попадают
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS `idx_notification_outbox_pending`
+            ON `notification_outbox` (`next_attempt_at`) WHERE `status` = 'pending'
+        """)
+
+    def _migration_outbox_expiry(self):
+        # После expires_at напоминание не отправляется (встреча прошла или текст устарел).
+        # Ожидающим записям без срока дается 15 минут от следующей попытки
+        if self._add_column('notification_outbox', 'expires_at', 'REAL'):
+            self.cursor.execute("""
+                UPDATE `notification_outbox` SET `expires_at` = `next_attempt_at` + 900 WHERE `status` = 'pending'
+            """)
+
+    def _migration_enrollment_owner(self):
+        # Владелец курса копируется в запись на курс (владелец у курса не меняется): индекс (owner_id, id)
+        # отдает записи преподавателя сразу в порядке id, без сортировки в get_students_without_appointments
+        if self._add_column('enrollments', 'owner_id', 'INTEGER'):
+            self.cursor.execute("""
+                UPDATE `enrollments`
+                SET `owner_id` = (SELECT c.`owner_id` FROM `courses` c WHERE c.`id` = `enrollments`.`course_id`)
+            """)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS `idx_enrollments_owner` ON `enrollments` (`owner_id`)")
+
+    def explain(self, sql, params=()):
+        return [row['detail'] for row in self.cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+
+    def _add_column(self, table, column, definition):
+        columns = [row['name'] for row in self.cursor.execute(f"PRAGMA table_info(`{table}`)").fetchall()]
+        if column in columns:
+            return False
+        self.cursor.execute(f"ALTER TABLE `{table}` ADD COLUMN `{column}` {definition}")
+        return True
 
     # User methods
     def add_user(self, user_id):
-        with self.connection:
+        with self.transaction():
             self.cursor.execute("INSERT INTO `users` (`user_id`) VALUES (?)", (user_id,))
-            self.connection.commit()
 
     def user_exists(self, user_id):
         with self.connection:
@@ -114,9 +475,8 @@ class Database:
             return bool(result)
 
     def set_nickname(self, user_id, nickname):
-        with self.connection:
+        with self.transaction():
             self.cursor.execute("UPDATE `users` SET `nickname` = ? WHERE `user_id` = ?", (nickname, user_id))
-            self.connection.commit()
 
     def get_signup(self, user_id):
         with self.connection:
@@ -126,9 +486,14 @@ class Database:
             return None
 
     def set_signup(self, user_id, sign_up):
-        with self.connection:
+        with self.transaction():
             self.cursor.execute("UPDATE `users` SET `sign_up` = ? WHERE `user_id` = ?", (sign_up, user_id))
-            self.connection.commit()
+
+    def get_profile(self, user_id):
+        with self.connection:
+            return self.cursor.execute("""
+                SELECT `user_id`, `nickname`, `sign_up`, `rules` FROM `users` WHERE `user_id` = ?
+            """, (user_id,)).fetchone()
 
     def get_rules(self, user_id):
         with self.connection:
@@ -138,9 +503,8 @@ class Database:
             return None
 
     def set_rules(self, user_id, rules):
-        with self.connection:
+        with self.transaction():
             self.cursor.execute("UPDATE `users` SET `rules` = ? WHERE `user_id` = ?", (rules, user_id))
-            self.connection.commit()
 
     # Course methods
     '''def add_course(self, course_name, owner_id, password, registration_deadline, google_sheet_url):
@@ -152,12 +516,11 @@ class Database:
             self.connection.commit()'''
 
     def add_course(self, course_name, owner_id, password, registration_deadline, google_sheet_url):
-        with self.connection:
+        with self.transaction():
             self.cursor.execute("""
                 INSERT INTO `courses` (`course_name`, `owner_id`, `password`, `registration_deadline`, `google_sheet_url`, `parsing_time`)
                 VALUES (?, ?, ?, ?, ?, ?)
             """, (course_name, owner_id, password, registration_deadline, google_sheet_url, datetime.now().isoformat()))
-            self.connection.commit()
             return self.cursor.lastrowid
         
     '''def add_skills(self, course_name, skills):
@@ -170,13 +533,64 @@ class Database:
             self.connection.commit()'''
     
     def add_skills(self, course_id, course_name, skills):
-        with self.connection:
-            for skill in skills:
-                self.cursor.execute("""
-                    INSERT INTO `skills` (`course_name`, `course_id`, `skill`, `link`, `start_date`, `end_date`)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (course_name, course_id, skill[0], skill[1], skill[2], skill[3]))
-            self.connection.commit()
+        # skills - любой итерируемый объект (в том числе генератор), пишется пачками по SKILLS_CHUNK_SIZE
+        with self.transaction():
+            self._upsert_skills(course_id, course_name, skills)
+            self._rebuild_course_weeks(course_id)
+
+    def rebuild_course_weeks(self, course_id):
+        with self.transaction():
+            self._rebuild_course_weeks(course_id)
+
+    def _rebuild_course_weeks(self, course_id):
+        # Нормализует даты навыков в номера недель и пересобирает материализованный индекс
+        # course_week_skills: (course_id, week) -> навыки, которые изучаются на этой неделе
+        skills = self.cursor.execute("""
+            SELECT `id`, `skill`, `link`, `start_date`, `end_date` FROM `skills` WHERE `course_id` = ?
+        """, (course_id,)).fetchall()
+        weeks, course_start = week_ordinals(
+            {skill['start_date'] for skill in skills} | {skill['end_date'] for skill in skills})
+
+        updates = []
+        week_rows = []
+        for skill in skills:
+            start_week, end_week = weeks[skill['start_date']], weeks[skill['end_date']]
+            updates.append((start_week, end_week, skill['id']))
+            if start_week is None or end_week is None:
+                logging.warning(f"Course {course_id}: unknown week for skill {skill['skill']!r}")
+                continue
+            week_rows.extend((course_id, week, skill['id'], skill['skill'], skill['link'])
+                             for week in range(start_week, end_week + 1))
+
+        self.cursor.executemany("UPDATE `skills` SET `start_week` = ?, `end_week` = ? WHERE `id` = ?", updates)
+        self.cursor.execute("DELETE FROM `course_week_skills` WHERE `course_id` = ?", (course_id,))
+        self.cursor.executemany("""
+            INSERT INTO `course_week_skills` (`course_id`, `week`, `skill_id`, `skill`, `link`)
+            VALUES (?, ?, ?, ?, ?)
+        """, week_rows)
+        self.cursor.execute("UPDATE `courses` SET `start_date` = ? WHERE `id` = ?",
+                            (course_start.isoformat() if course_start else None, course_id))
+
+    def _upsert_skills(self, course_id, course_name, skills, seen=None):
+        # Вызывающий метод после записи навыков пересобирает недели курса (_rebuild_course_weeks)
+        skills = iter(skills)
+        while True:
+            chunk = [(course_name, course_id, skill[0], skill[1], skill[2], skill[3])
+                     for skill in itertools.islice(skills, SKILLS_CHUNK_SIZE)]
+            if not chunk:
+                break
+            if seen is not None:
+                seen.update(row[2] for row in chunk)
+            # Повторный импорт не дублирует навыки: строка обновляется, только если что-то изменилось
+            self.cursor.executemany("""
+                INSERT INTO `skills` (`course_name`, `course_id`, `skill`, `link`, `start_date`, `end_date`)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (`course_id`, `skill`) DO UPDATE SET
+                    `course_name` = excluded.`course_name`, `link` = excluded.`link`,
+                    `start_date` = excluded.`start_date`, `end_date` = excluded.`end_date`
+                WHERE `link` IS NOT excluded.`link` OR `start_date` IS NOT excluded.`start_date`
+                    OR `end_date` IS NOT excluded.`end_date` OR `course_name` IS NOT excluded.`course_name`
+            """, chunk)
 
     def get_courses(self):
         self.cursor.execute("SELECT id, course_name, registration_deadline FROM courses")
@@ -187,12 +601,11 @@ class Database:
         return self.cursor.fetchone()[0]
 
     def enroll_user(self, user_id, course_id):
-        with self.connection:
+        with self.transaction():
             self.cursor.execute("""
-                INSERT INTO enrollments (user_id, course_id, week_number)
-                VALUES (?, ?, 0)
-            """, (user_id, course_id))
-            self.connection.commit()
+                INSERT OR IGNORE INTO enrollments (user_id, course_id, week_number, enrolled_at, owner_id)
+                VALUES (?, ?, 0, ?, (SELECT owner_id FROM courses WHERE id = ?))
+            """, (user_id, course_id, datetime.now().isoformat(), course_id))
 
     def get_user_enrollments(self, user_id):
         with self.connection:
@@ -210,20 +623,64 @@ class Database:
                 WHERE course_name = ? AND ? BETWEEN start_date AND end_date
             """, (course_name, week_number)).fetchall()'''
 
-    def get_users_without_appointments(self):
+    def get_students_without_appointments(self, owner_id=None, after_id=None, before_id=None, limit=10):
+        # Записи на курсы (владельца owner_id или все), по которым еще нет встречи, постранично по id записи.
+        # Как и в get_homework_page, строки идут от курсора и запрашивается limit + 1
+        conditions = ["NOT EXISTS (SELECT 1 FROM `appointments` a WHERE a.`user_id` = e.`user_id` "
+                      "AND a.`course_id` = e.`course_id`)"]
+        params = []
+        if owner_id is not None:
+            conditions.append("e.`owner_id` = ?")
+            params.append(owner_id)
+        order = "e.`id`"
+        if after_id is not None:
+            conditions.append("e.`id` > ?")
+            params.append(after_id)
+        elif before_id is not None:
+            conditions.append("e.`id` < ?")
+            params.append(before_id)
+            order = "e.`id` DESC"
+        return self.cursor.execute(f"""
+            SELECT e.`id`, e.`user_id`, e.`course_id`, u.`nickname`, c.`course_name`
+            FROM `enrollments` e
+            JOIN `courses` c ON c.`id` = e.`course_id`
+            JOIN `users` u ON u.`user_id` = e.`user_id`
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {order}
+            LIMIT ?
+        """, (*params, limit + 1)).fetchall()
+
+    def get_enrollment(self, enrollment_id):
+        return self.cursor.execute("""
+            SELECT e.`id`, e.`user_id`, e.`course_id`, c.`owner_id`
+            FROM `enrollments` e
+            JOIN `courses` c ON c.`id` = e.`course_id`
+            WHERE e.`id` = ?
+        """, (enrollment_id,)).fetchone()
+
+    def add_appointment(self, teacher_id, user_id, course_id, weekday, time):
+        with self.transaction():
+            self.cursor.execute("""
+                INSERT INTO `appointments` (`teacher_id`, `user_id`, `course_id`, `weekday`, `time`, `minute_of_week`)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (teacher_id, user_id, course_id, weekday, time, minute_of_week(weekday, time)))
+            return self.cursor.lastrowid
+
+    def get_appointment(self, appointment_id):
         with self.connection:
             return self.cursor.execute("""
-                SELECT `user_id`, `nickname` FROM `users`
-                WHERE `user_id` NOT IN (SELECT `user_id` FROM `appointments`)
-            """).fetchall()
+                SELECT `id`, `user_id`, `course_id`, `time`, `minute_of_week`
+                FROM `appointments`
+                WHERE `id` = ?
+            """, (appointment_id,)).fetchone()
 
-    def add_appointment(self, teacher_id, user_id, weekday, time):
+    def get_appointment_schedule(self):
         with self.connection:
-            self.cursor.execute("""
-                INSERT INTO `appointments` (`teacher_id`, `user_id`, `weekday`, `time`)
-                VALUES (?, ?, ?, ?)
-            """, (teacher_id, user_id, weekday, time))
-            self.connection.commit()
+            return self.cursor.execute("""
+                SELECT `id`, `user_id`, `course_id`, `time`, `minute_of_week`
+                FROM `appointments`
+                WHERE `minute_of_week` IS NOT NULL
+            """).fetchall()
 
     def get_appointments(self):
         with self.connection:
@@ -252,20 +709,18 @@ class Database:
             return result
 
     def add_schedule(self, course_id, lesson_time):
-        with self.connection:
+        with self.transaction():
             self.cursor.execute("INSERT INTO `schedules` (`course_id`, `lesson_time`) VALUES (?, ?)", (course_id, lesson_time))
-            self.connection.commit()
 
     def get_enrolled_users(self, course_id):
         return self.cursor.execute("SELECT `user_id` FROM `enrollments` WHERE `course_id` = ?", (course_id,)).fetchall()
 
     def submit_homework(self, user_id, course_id, file_link):
-        with self.connection:
+        with self.transaction():
             self.cursor.execute("""
                 INSERT INTO `homework` (`user_id`, `course_id`, `file_link`, `submitted_at`)
                 VALUES (?, ?, ?, ?)
             """, (user_id, course_id, file_link, datetime.now().isoformat()))
-            self.connection.commit()
 
     def get_homework(self, course_id):
         return self.cursor.execute("""
@@ -275,15 +730,14 @@ class Database:
         """, (course_id,)).fetchall()
 
     def delete_enrollment(self, user_id, course_id):
-        with self.connection:
+        with self.transaction():
             self.cursor.execute("DELETE FROM `enrollments` WHERE `user_id` = ? AND `course_id` = ?", (user_id, course_id))
-            self.connection.commit()
 
     def get_user_enrollments(self, user_id):
         with self.connection:
             rows = self.cursor.execute("""
-                SELECT e.course_id, c.course_name, e.week_number
-                FROM enrollments e
+                SELECT e.course_id, c.course_name, e.week
+                FROM enrollment_weeks e
                 JOIN courses c ON e.course_id = c.id
                 WHERE e.user_id = ?
             """, (user_id,)).fetchall()
@@ -299,22 +753,21 @@ class Database:
             rows = self.cursor.execute("SELECT DISTINCT user_id FROM enrollments").fetchall()
             return [dict(row) for row in rows]
 
-    def update_week_number(self, course_id, user_id):
-        with self.connection:
+    def set_week_override(self, user_id, course_id, week):
+        # week=None - вернуть неделю по календарю
+        with self.transaction():
             self.cursor.execute("""
-                UPDATE enrollments
-                SET week_number = week_number + 1
-                WHERE course_id = ? AND user_id = ?
-            """, (course_id, user_id))
+                UPDATE `enrollments` SET `week_override` = ? WHERE `user_id` = ? AND `course_id` = ?
+            """, (week, user_id, course_id))
+            return self.cursor.rowcount > 0
 
-    def get_skills_for_week(self, course_id, current_week):
-        with self.connection:
-            return self.cursor.execute("""
-                SELECT s.skill, s.link 
-                FROM skills s
-                JOIN enrollments e ON s.course_id = e.course_id
-                WHERE e.course_id = ? AND e.week_number = ?
-            """, (course_id, current_week)).fetchall()
+    def get_skills_for_week(self, course_id, week):
+        return self.cursor.execute("""
+            SELECT `skill`, `link`
+            FROM `course_week_skills`
+            WHERE `course_id` = ? AND `week` = ?
+            ORDER BY `skill_id`
+        """, (course_id, week)).fetchall()
         
     '''def get_skills_for_week(self, course_id, user_id, current_week):
         with self.connection:
@@ -325,14 +778,21 @@ class Database:
                 WHERE e.course_id = ? AND e.user_id = ? AND e.week_number = ?
             """, (course_id, user_id, current_week)).fetchall()'''
     
-    def has_sent_skills_notification(self, user_id, course_id):
-        with self.connection:
-            result = self.cursor.execute("""
-                SELECT 1 FROM skills_notifications
-                WHERE user_id = ? AND course_id = ?
-            """, (user_id, course_id)).fetchone()
-            return bool(result)
-        
+    def get_due_skills_digests(self):
+        # Ученики, у которых на текущей неделе курса есть навыки и подборка за эту неделю еще не отправлена
+        return self.cursor.execute("""
+            SELECT e.`user_id`, e.`course_id`, e.`week`
+            FROM `enrollment_weeks` e
+            WHERE EXISTS (
+                SELECT 1 FROM `course_week_skills` w
+                WHERE w.`course_id` = e.`course_id` AND w.`week` = e.`week`
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM `skills_notifications` n
+                WHERE n.`user_id` = e.`user_id` AND n.`course_id` = e.`course_id` AND n.`week` = e.`week`
+            )
+        """).fetchall()
+
     def get_last_notification(self, user_id, course_id, notification_type):
         with self.connection:
             row = self.cursor.execute("""
@@ -342,30 +802,137 @@ class Database:
             return datetime.fromisoformat(row['last_sent']) if row else None
 
     def update_notification_log(self, user_id, course_id, notification_type, last_sent):
-        with self.connection:
+        with self.transaction():
             self.cursor.execute("""
                 INSERT INTO notification_log (user_id, course_id, notification_type, last_sent)
                 VALUES (?, ?, ?, ?)
                 ON CONFLICT (user_id, course_id, notification_type)
                 DO UPDATE SET last_sent = excluded.last_sent
             """, (user_id, course_id, notification_type, last_sent))
-            self.connection.commit()
+
+    def enqueue_notifications(self, notifications, now):
+        # notifications - [(user_id, course_id, notification_type, text), ...].
+        # В одной транзакции напоминание помечается в notification_log и кладется в notification_outbox;
+        # уже забранные на этой неделе (другим процессом или прошлым запуском) пропускаются.
+        # Возвращает число поставленных в очередь
+        created_at = datetime.now().isoformat()
+        enqueued = 0
+        with self.transaction():
+            for user_id, course_id, notification_type, text in notifications:
+                self.cursor.execute("""
+                    INSERT INTO notification_log (user_id, course_id, notification_type, last_sent)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id, course_id, notification_type)
+                    DO UPDATE SET last_sent = excluded.last_sent
+                    WHERE notification_log.last_sent <= ?
+                """, (user_id, course_id, notification_type, now, now - timedelta(days=6)))
+                if self.cursor.rowcount == 0:
+                    continue
+                self.cursor.execute("""
+                    INSERT INTO `notification_outbox` (`user_id`, `course_id`, `notification_type`, `text`,
+                                                       `next_attempt_at`, `expires_at`, `created_at`)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (user_id, course_id, notification_type, text, time.time(),
+                      notification_expiry(notification_type, now), created_at))
+                enqueued += 1
+        return enqueued
+
+    def get_outbox_batch(self, now, limit=50):
+        with self.connection:
+            return self.cursor.execute("""
+                SELECT `id`, `user_id`, `notification_type`, `text`, `attempts`, `expires_at`
+                FROM `notification_outbox`
+                WHERE `status` = 'pending' AND `next_attempt_at` <= ?
+                ORDER BY `next_attempt_at`
+                LIMIT ?
+            """, (now, limit)).fetchall()
+
+    def complete_outbox(self, sent, retries, failed):
+        # sent - [id, ...], retries - [(id, ошибка, next_attempt_at), ...], failed - [(id, ошибка), ...]
+        sent_at = datetime.now().isoformat()
+        with self.transaction():
+            self.cursor.executemany("""
+                UPDATE `notification_outbox`
+                SET `status` = 'sent', `attempts` = `attempts` + 1, `sent_at` = ?, `last_error` = NULL
+                WHERE `id` = ?
+            """, [(sent_at, outbox_id) for outbox_id in sent])
+            self.cursor.executemany("""
+                UPDATE `notification_outbox`
+                SET `attempts` = `attempts` + 1, `last_error` = ?, `next_attempt_at` = ?
+                WHERE `id` = ?
+            """, [(error, next_attempt_at, outbox_id) for outbox_id, error, next_attempt_at in retries])
+            self.cursor.executemany("""
+                UPDATE `notification_outbox`
+                SET `status` = 'failed', `attempts` = `attempts` + 1, `last_error` = ?
+                WHERE `id` = ?
+            """, [(error, outbox_id) for outbox_id, error in failed])
+
+    def purge_outbox(self, before):
+        # Удалить доставленные и окончательно не доставленные записи старше before
+        with self.transaction():
+            self.cursor.execute("""
+                DELETE FROM `notification_outbox` WHERE `status` != 'pending' AND `created_at` < ?
+            """, (before.isoformat(),))
+            return self.cursor.rowcount
+
+    def acquire_lease(self, name, holder, ttl, now=None):
+        # Захватить или продлить аренду: получится, если она свободна, истекла или уже принадлежит holder
+        now = time.time() if now is None else now
+        with self.transaction():
+            self.cursor.execute("""
+                INSERT INTO `leases` (`name`, `holder`, `expires_at`) VALUES (?, ?, ?)
+                ON CONFLICT (`name`) DO UPDATE SET `holder` = excluded.`holder`, `expires_at` = excluded.`expires_at`
+                WHERE `leases`.`holder` = excluded.`holder` OR `leases`.`expires_at` < ?
+            """, (name, holder, now + ttl, now))
+            return self.cursor.rowcount > 0
+
+    def release_lease(self, name, holder):
+        with self.transaction():
+            self.cursor.execute("DELETE FROM `leases` WHERE `name` = ? AND `holder` = ?", (name, holder))
+
+    def get_due_notifications(self, now, grace_minutes=1):
+        # Напоминание должно уйти, если (встреча - смещение) попадает в [now - grace, now].
+        # Для каждого типа это один диапазон по индексу minute_of_week (два, если он переходит через конец недели)
+        now_minute = now.weekday() * 24 * 60 + now.hour * 60 + now.minute
+        # Тип уже отправлен на этой неделе, если запись в логе свежее 6 дней
+        sent_after = now - timedelta(days=6)
+        selects = []
+        params = []
+        for offset, notification_type in NOTIFICATION_TYPES:
+            low = (now_minute - grace_minutes + offset) % MINUTES_IN_WEEK
+            high = (now_minute + offset) % MINUTES_IN_WEEK
+            ranges = [(low, high)] if low <= high else [(low, MINUTES_IN_WEEK - 1), (0, high)]
+            for range_low, range_high in ranges:
+                selects.append("""
+                    SELECT a.id AS appointment_id, a.user_id, a.course_id, a.time, ? AS notification_type
+                    FROM appointments a
+                    WHERE a.minute_of_week BETWEEN ? AND ?
+                    AND NOT EXISTS (
+                        SELECT 1 FROM notification_log n
+                        WHERE n.user_id = a.user_id AND n.course_id = a.course_id
+                        AND n.notification_type = ? AND n.last_sent > ?
+                    )
+                """)
+                params.extend((notification_type, range_low, range_high, notification_type, sent_after))
+        with self.connection:
+            return self.cursor.execute(" UNION ALL ".join(selects), params).fetchall()
 
     def get_current_week(self, course_id, user_id):
         with self.connection:
             result = self.cursor.execute("""
-                SELECT week_number FROM enrollments
+                SELECT week FROM enrollment_weeks
                 WHERE user_id = ? AND course_id = ?
             """, (user_id, course_id)).fetchone()
-            return result['week_number'] if result else None
+            return result['week'] if result else None
         
-    def record_skills_notification(self, user_id, course_id):
-        with self.connection:
-            self.cursor.execute("""
-                INSERT INTO skills_notifications (user_id, course_id, sent_at)
-                VALUES (?, ?, ?)
-            """, (user_id, course_id, datetime.now().isoformat()))
-            self.connection.commit()
+    def record_skills_notifications(self, deliveries):
+        # deliveries - [(user_id, course_id, week), ...]
+        sent_at = datetime.now().isoformat()
+        with self.transaction():
+            self.cursor.executemany("""
+                INSERT OR IGNORE INTO `skills_notifications` (`user_id`, `course_id`, `week`, `sent_at`)
+                VALUES (?, ?, ?, ?)
+            """, [(user_id, course_id, week, sent_at) for user_id, course_id, week in deliveries])
 
     def get_user_courses_as_owner(self, user_id):
         with self.connection:
@@ -379,15 +946,65 @@ class Database:
         with self.connection:
             return self.cursor.execute("SELECT id, course_name FROM courses").fetchall()
 
-    def get_last_homework(self, course_id, limit=50):
+    def get_courses_for_sync(self):
         with self.connection:
             return self.cursor.execute("""
-                SELECT user_id, file_link, submitted_at
-                FROM homework
-                WHERE course_id = ?
-                ORDER BY submitted_at DESC
+                SELECT id, course_name, google_sheet_url, sheet_modified_time
+                FROM courses
+                WHERE google_sheet_url IS NOT NULL
+            """).fetchall()
+
+    def sync_skills(self, course_id, course_name, skills, sheet_modified_time):
+        # Навыки пишутся потоком через upsert по (course_id, skill): меняются только новые и измененные строки,
+        # затем удаляются навыки, которых больше нет в таблице
+        with self.transaction():
+            seen = set()
+            changes_before = self.connection.total_changes
+            self._upsert_skills(course_id, course_name, skills, seen)
+            upserted = self.connection.total_changes - changes_before
+            deletes = [(row['id'],) for row in self.cursor.execute(
+                "SELECT id, skill FROM skills WHERE course_id = ?", (course_id,)).fetchall()
+                       if row['skill'] not in seen]
+            self.cursor.executemany("DELETE FROM skills WHERE id = ?", deletes)
+            if upserted or deletes:
+                self._rebuild_course_weeks(course_id)
+            self.cursor.execute("""
+                UPDATE courses SET parsing_time = ?, sheet_modified_time = ? WHERE id = ?
+            """, (datetime.now().isoformat(), sheet_modified_time, course_id))
+            return upserted, len(deletes)
+
+    def get_homework_page(self, course_id, before_id=None, after_id=None, limit=20):
+        # Keyset-пагинация по индексу (course_id, submitted_at): курсор - id крайней работы соседней страницы.
+        # Строки идут от курсора (для after_id - от старых к новым), запрашивается limit + 1:
+        # лишняя строка означает, что в эту сторону есть еще страница
+        if after_id is not None:
+            return self.cursor.execute("""
+                SELECT h.id, h.user_id, u.nickname, h.file_link, h.submitted_at
+                FROM homework h
+                LEFT JOIN users u ON u.user_id = h.user_id
+                WHERE h.course_id = ?
+                  AND (h.submitted_at, h.id) > (SELECT submitted_at, id FROM homework WHERE id = ?)
+                ORDER BY h.submitted_at, h.id
                 LIMIT ?
-            """, (course_id, limit)).fetchall()
+            """, (course_id, after_id, limit + 1)).fetchall()
+        if before_id is not None:
+            return self.cursor.execute("""
+                SELECT h.id, h.user_id, u.nickname, h.file_link, h.submitted_at
+                FROM homework h
+                LEFT JOIN users u ON u.user_id = h.user_id
+                WHERE h.course_id = ?
+                  AND (h.submitted_at, h.id) < (SELECT submitted_at, id FROM homework WHERE id = ?)
+                ORDER BY h.submitted_at DESC, h.id DESC
+                LIMIT ?
+            """, (course_id, before_id, limit + 1)).fetchall()
+        return self.cursor.execute("""
+            SELECT h.id, h.user_id, u.nickname, h.file_link, h.submitted_at
+            FROM homework h
+            LEFT JOIN users u ON u.user_id = h.user_id
+            WHERE h.course_id = ?
+            ORDER BY h.submitted_at DESC, h.id DESC
+            LIMIT ?
+        """, (course_id, limit + 1)).fetchall()
 
     def get_nickname(self, user_id):
         with self.connection:
@@ -403,7 +1020,180 @@ class Database:
                 WHERE e.user_id = ?
             """, (user_id,)).fetchall()
         
-    def get_users(self):
+    def get_users(self, limit=None):
+        # limit - только первые пользователи (кнопки выбора в /setrules), без чтения всей таблицы
         with self.connection:
-            return self.cursor.execute("SELECT user_id, nickname FROM users").fetchall()
+            if limit is None:
+                return self.cursor.execute("SELECT user_id, nickname FROM users").fetchall()
+            return self.cursor.execute("SELECT user_id, nickname FROM users ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    def search_users(self, text, limit=20):
+        query = search_query(text)
+        if not query:
+            return []
+        return self.cursor.execute("""
+            SELECT u.`user_id`, u.`nickname`, u.`rules`
+            FROM `users_search` s
+            JOIN `users` u ON u.`id` = s.rowid
+            WHERE `users_search` MATCH ?
+            ORDER BY s.rank
+            LIMIT ?
+        """, (query, limit)).fetchall()
+
+    def search_courses(self, text, owner_id=None, student_id=None, limit=20):
+        # owner_id - только курсы преподавателя, student_id - только курсы, на которые записан ученик
+        query = search_query(text)
+        if not query:
+            return []
+        conditions = ["`courses_search` MATCH ?"]
+        params = [query]
+        if owner_id is not None:
+            conditions.append("c.`owner_id` = ?")
+            params.append(owner_id)
+        if student_id is not None:
+            conditions.append("EXISTS (SELECT 1 FROM `enrollments` e WHERE e.`user_id` = ? AND e.`course_id` = c.`id`)")
+            params.append(student_id)
+        return self.cursor.execute(f"""
+            SELECT c.`id`, c.`course_name`
+            FROM `courses_search` s
+            JOIN `courses` c ON c.`id` = s.rowid
+            WHERE {' AND '.join(conditions)}
+            ORDER BY s.rank
+            LIMIT ?
+        """, (*params, limit)).fetchall()
+
+
+class AsyncDatabase:
+    # Тот же набор методов, что у Database, но запросы выполняются в отдельных потоках,
+    # у каждого потока свое соединение с базой.
+    # mode='wal': база в режиме WAL, все записи идут через один поток, который объединяет
+    # записи, пришедшие за group_commit_window секунд, в одну транзакцию.
+    # profiler (profiler.QueryProfiler) подключается к соединению каждого потока
+    def __init__(self, db_file, workers=4, mode='default', group_commit_window=0.002, max_batch=500,
+                 profiler=None):
+        self.db_file = db_file
+        self.profiler = profiler
+        self.mode = mode
+        self.group_commit_window = group_commit_window
+        self.max_batch = max_batch
+        database = Database(db_file)
+        if mode == 'wal':
+            database.cursor.execute("PRAGMA journal_mode=WAL")
+        database.close()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db',
+                                            initializer=self._connect)
+        self._write_queue = None
+        self._writer = None
+        self._write_listeners = []
+        self._call_listeners = []
+        if mode == 'wal':
+            self._write_queue = queue.Queue()
+            self._writer = threading.Thread(target=self._write_loop, name='db-writer', daemon=True)
+            self._writer.start()
+
+    def add_write_listener(self, callback):
+        # callback(name, args) вызывается в цикле событий после каждой успешной записи
+        self._write_listeners.append(callback)
+
+    def add_call_listener(self, callback):
+        # callback(name, seconds) - время каждого вызова метода (с ожиданием в очереди), в том числе неудачного
+        self._call_listeners.append(callback)
+
+    def _notify_call(self, name, started):
+        seconds = time.perf_counter() - started
+        for callback in self._call_listeners:
+            callback(name, seconds)
+
+    def _notify_write(self, name, args):
+        for callback in self._write_listeners:
+            callback(name, args)
+
+    def _connect(self):
+        self._local.db = self._open()
+
+    def _open(self):
+        database = Database(self.db_file, create=False)
+        if self.profiler:
+            self.profiler.attach(database)
+        return database
+
+    def _call(self, name, *args, **kwargs):
+        return getattr(self._local.db, name)(*args, **kwargs)
+
+    def _write_loop(self):
+        database = self._open()
+        while True:
+            job = self._write_queue.get()
+            if job is None:
+                break
+            batch = [job]
+            stop = False
+            deadline = time.monotonic() + self.group_commit_window
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._write_queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+
+            try:
+                results = database.run_batch([(name, args, kwargs) for name, args, kwargs, _, _ in batch])
+            except sqlite3.Error as e:
+                logging.exception(f"Group commit of {len(batch)} writes failed")
+                results = [(False, e)] * len(batch)
+            for (_, _, _, future, loop), (ok, value) in zip(batch, results):
+                loop.call_soon_threadsafe(self._resolve, future, ok, value)
+            if stop:
+                break
+        database.close()
+
+    @staticmethod
+    def _resolve(future, ok, value):
+        if future.cancelled():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(Database, name, None)):
+            raise AttributeError(name)
+
+        if self._write_queue is not None and name in WRITE_METHODS:
+            async def method(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                started = time.perf_counter()
+                self._write_queue.put((name, args, kwargs, future, loop))
+                try:
+                    result = await future
+                finally:
+                    self._notify_call(name, started)
+                self._notify_write(name, args)
+                return result
+        else:
+            async def method(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                started = time.perf_counter()
+                try:
+                    result = await loop.run_in_executor(self._executor,
+                                                        functools.partial(self._call, name, *args, **kwargs))
+                finally:
+                    self._notify_call(name, started)
+                if name in WRITE_METHODS:
+                    self._notify_write(name, args)
+                return result
+
+        setattr(self, name, method)
+        return method
 
+    def close(self):
+        if self._writer:
+            self._write_queue.put(None)
+            self._writer.join()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,227 @@
+import asyncio
+import contextlib
+import copy
+import json
+import logging
+import sqlite3
+import time
+import typing
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.dispatcher.storage import BaseStorage
+
+STATE_TTL = 7 * 24 * 3600
+MAX_CACHED = 10000
+FLUSH_INTERVAL = 1
+COMPRESS_FROM = 1024
+
+
+def dump_data(data):
+    raw = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+    if len(raw) >= COMPRESS_FROM:
+        return b'z' + zlib.compress(raw)
+    return b'j' + raw
+
+
+def load_data(blob):
+    if not blob:
+        return {}
+    raw = zlib.decompress(blob[1:]) if blob[:1] == b'z' else blob[1:]
+    return json.loads(raw)
+
+
+class SQLiteStorage(BaseStorage):
+    # Состояния FSM в SQLite: чтение из LRU-кеша в памяти, запись в базу пачками раз в flush_interval секунд,
+    # состояния, не менявшиеся дольше ttl, считаются сброшенными.
+    # shared=True - апдейты обрабатывают несколько экземпляров бота: без кеша, каждое изменение сразу пишется в базу
+    def __init__(self, db_file, ttl=STATE_TTL, max_cached=MAX_CACHED, flush_interval=FLUSH_INTERVAL, shared=False):
+        self.ttl = ttl
+        self.shared = shared
+        self.max_cached = 0 if shared else max_cached
+        self.flush_interval = flush_interval
+        self._connection = sqlite3.connect(db_file, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS `fsm_states` (
+                    `chat` TEXT NOT NULL,
+                    `user` TEXT NOT NULL,
+                    `state` TEXT,
+                    `data` BLOB,
+                    `updated_at` REAL NOT NULL,
+                    PRIMARY KEY (`chat`, `user`)
+                );
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS `idx_fsm_states_updated` ON `fsm_states` (`updated_at`)")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fsm')
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._flushing = {}
+        self._flush_lock = asyncio.Lock()
+        # Без общего кеша update_data - чтение и запись; внутри процесса они не должны перемежаться
+        self._update_lock = asyncio.Lock()
+        self._flusher = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _load(self, key):
+        row = self._connection.execute("""
+            SELECT `state`, `data`, `updated_at` FROM `fsm_states`
+            WHERE `chat` = ? AND `user` = ?
+        """, key).fetchone()
+        if row is None:
+            return None
+        return {'state': row[0], 'data': load_data(row[1]), 'updated_at': row[2]}
+
+    def _write(self, upserts, deletes):
+        with self._connection:
+            self._connection.executemany("""
+                INSERT INTO `fsm_states` (`chat`, `user`, `state`, `data`, `updated_at`)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (`chat`, `user`) DO UPDATE SET
+                    `state` = excluded.`state`, `data` = excluded.`data`, `updated_at` = excluded.`updated_at`
+            """, upserts)
+            self._connection.executemany("DELETE FROM `fsm_states` WHERE `chat` = ? AND `user` = ?", deletes)
+            self._connection.execute("DELETE FROM `fsm_states` WHERE `updated_at` < ?", (time.time() - self.ttl,))
+
+    def _delete_states(self, states):
+        with self._connection:
+            placeholders = ', '.join('?' * len(states))
+            keys = self._connection.execute(
+                f"SELECT `chat`, `user` FROM `fsm_states` WHERE `state` IN ({placeholders})", states).fetchall()
+            self._connection.execute(f"DELETE FROM `fsm_states` WHERE `state` IN ({placeholders})", states)
+            return keys
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    async def _get(self, chat, user):
+        self._ensure_flusher()
+        key = self._key(chat, user)
+        record = self._cache.get(key)
+        if record is None:
+            if key in self._dirty:
+                record = self._dirty[key]
+            elif key in self._flushing:
+                record = self._flushing[key]
+            else:
+                record = await self._run(self._load, key)
+        # Срок проверяется и для записей из кеша: иначе состояние, которое не вытеснили, не истекает никогда
+        if record is None or record['updated_at'] < time.time() - self.ttl:
+            record = {'state': None, 'data': {}, 'updated_at': time.time()}
+        self._remember(key, record)
+        return key, record
+
+    def _remember(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached:
+            # Вытесненная запись остается в _dirty до ближайшей записи в базу
+            self._cache.popitem(last=False)
+
+    async def _save(self, key, record):
+        record['updated_at'] = time.time()
+        self._remember(key, record)
+        self._dirty[key] = record
+        if self.shared:
+            await self.flush()
+
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Failed to flush FSM states")
+
+    async def flush(self):
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        if not self._dirty:
+            return
+        self._flushing, self._dirty = self._dirty, {}
+        upserts = []
+        deletes = []
+        for key, record in self._flushing.items():
+            if record['state'] is None and not record['data']:
+                deletes.append(key)
+            else:
+                upserts.append((*key, record['state'], dump_data(record['data']), record['updated_at']))
+        try:
+            await self._run(self._write, upserts, deletes)
+        except Exception:
+            # Не потерять изменения: вернуть их в очередь, если их не перезаписали новые
+            for key, record in self._flushing.items():
+                self._dirty.setdefault(key, record)
+            raise
+        finally:
+            self._flushing = {}
+
+    async def reset_states(self, states):
+        # Сбросить у всех пользователей перечисленные состояния (например, зависшие после перезапуска);
+        # возвращает [(chat, user), ...], у кого они были
+        states = [self.resolve_state(state) for state in states]
+        await self.flush()
+        keys = await self._run(self._delete_states, states)
+        for key in [key for key, record in self._cache.items() if record['state'] in states]:
+            del self._cache[key]
+        return keys
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+    async def wait_closed(self):
+        self._executor.shutdown(wait=True)
+        self._connection.close()
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._get(chat, user)
+        return record['state'] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        key, record = await self._get(chat, user)
+        record['state'] = self.resolve_state(state)
+        await self._save(key, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._get(chat, user)
+        record['data'] = copy.deepcopy(data) if data else {}
+        await self._save(key, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        async with self._update_lock if self.shared else contextlib.nullcontext():
+            key, record = await self._get(chat, user)
+            record['data'].update(copy.deepcopy(data or {}), **kwargs)
+            await self._save(key, record)
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+
+from conf import LEADER_LEASE_SECONDS
+
+
+class LeaderElection:
+    # Аренда в общей базе SQLite: задачи планировщика выполняет только процесс, который ее держит.
+    # Лидер продлевает аренду каждые ttl / 3 секунд; если он перестал продлевать, после ttl аренду забирает другой
+    def __init__(self, db, name='scheduler', ttl=LEADER_LEASE_SECONDS, on_elected=None, on_demoted=None):
+        self.db = db
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.is_leader = False
+        self._renewed_at = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self.is_leader:
+            await self._demote()
+            # Освободить аренду сразу, чтобы другой процесс не ждал ее истечения
+            await self.db.release_lease(self.name, self.holder)
+
+    async def _run(self):
+        while True:
+            try:
+                acquired = await self.db.acquire_lease(self.name, self.holder, self.ttl)
+            except Exception:
+                logging.exception("Failed to renew scheduler lease")
+                acquired = None
+            if acquired:
+                self._renewed_at = time.monotonic()
+                if not self.is_leader:
+                    await self._elect()
+            elif self.is_leader and (acquired is False or time.monotonic() - self._renewed_at >= self.ttl * 2 / 3):
+                # Аренду забрали или ее не удается продлить - не ждать истечения, пока ее заберет другой процесс
+                await self._demote()
+            await asyncio.sleep(self.ttl / 3)
+
+    async def _elect(self):
+        self.is_leader = True
+        logging.info(f"{self.holder} is now the scheduler leader")
+        if self.on_elected:
+            await self.on_elected()
+
+    async def _demote(self):
+        self.is_leader = False
+        logging.warning(f"{self.holder} lost scheduler leadership")
+        if self.on_demoted:
+            await self.on_demoted()
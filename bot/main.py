@@ -1,119 +1,204 @@
+import asyncio
+import functools
+import hmac
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import pytz
-from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram import Dispatcher, executor, types
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.utils.exceptions import TelegramAPIError
+from aiogram.utils.markdown import quote_html
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 import navigation
-from conf import API_TOKEN, CREDENTIALS_FILE
-from db import Database
-from parsering import parse_google_sheet
+from broadcast import MESSAGE_LIMIT, SENT, UNREACHABLE, Broadcaster, split_message
+from conf import API_TOKEN, BOT_MODE, CREDENTIALS_FILE, DB_MODE, DB_PROFILE, METRICS_PORT, OUTBOX_RETENTION_DAYS, \
+    REPLICAS, SCHEDULER_MODE, SHEETS_RESYNC_MINUTES, SKILLS_DIGEST_MINUTES, SLOW_QUERY_MS, WEBAPP_HOST, \
+    WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL
+from db import WEEKDAYS, AsyncDatabase
+from fsm_storage import SQLiteStorage
+from leader import LeaderElection
+from metrics import DB_SECONDS, MetricsBot, MetricsMiddleware, start_metrics_server, timed_job
+from notifier import DeadlineScheduler
+from outbox import OutboxDispatcher
+from parsering import get_sheet_titles, get_spreadsheet_modified_time, iter_sheet_skills, parse_google_sheet
+from profiler import QueryProfiler
+from profiles import MAX_PROFILES, ProfileCache, ProfileMiddleware
+from week_skills import WeekSkillsCache
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+bot = MetricsBot(token=API_TOKEN)
+# Несколько экземпляров, обрабатывающих апдейты: кеши в памяти между ними не согласованы, поэтому выключаются
+shared_state = REPLICAS > 1
+storage = SQLiteStorage('database.db', shared=shared_state)
 dp = Dispatcher(bot, storage=storage)
+broadcaster = Broadcaster(bot)
+
+profiler = QueryProfiler(SLOW_QUERY_MS / 1000) if DB_PROFILE else None
+db = AsyncDatabase('database.db', mode=DB_MODE, profiler=profiler)
+profiles = ProfileCache(db, max_size=0 if shared_state else MAX_PROFILES)
+week_skills = WeekSkillsCache(db, enabled=not shared_state)
+db.add_call_listener(lambda name, seconds: DB_SECONDS.observe(seconds, name))
+dp.middleware.setup(MetricsMiddleware())
+dp.middleware.setup(ProfileMiddleware(profiles))
+
+import_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='sheets')
+import_tasks = set()
+HOMEWORK_PAGE_SIZE = 20
+STUDENTS_PAGE_SIZE = 10
+SEARCH_LIMIT = 20
+SEARCH_CACHE_TIME = 5
+
+
+def user_rules_of(profile):
+    return profile['rules'] if profile else 0
 
-db = Database('database.db')
-db.create_tables()
 
 # region Scheduler
 scheduler = AsyncIOScheduler(timezone=pytz.timezone("Europe/Moscow"))
 
 
 def schedule_notifications():
-    scheduler.add_job(check_for_notifications, trigger='interval', minutes=0.5)
-    scheduler.start()
-    logging.info("Notifications scheduled")
+    # Задачи добавляются в каждом процессе, но выполняются только у лидера (см. leader.py)
+    if SCHEDULER_MODE == 'deadline':
+        scheduler.add_job(sync_deadline_scheduler, trigger='interval', minutes=1)
+    else:
+        scheduler.add_job(check_for_notifications, trigger='interval', minutes=0.5)
+    scheduler.add_job(resync_course_skills, trigger='interval', minutes=SHEETS_RESYNC_MINUTES)
+    scheduler.add_job(send_skills_digests, trigger='interval', minutes=SKILLS_DIGEST_MINUTES)
+    scheduler.add_job(purge_notification_outbox, trigger='interval', days=1)
+    scheduler.start(paused=True)
+    election.start()
+    logging.info(f"Notifications scheduled ({SCHEDULER_MODE}), waiting for leadership")
+
+
+async def on_elected():
+    if SCHEDULER_MODE == 'deadline':
+        deadline_scheduler.start(db.get_appointment_schedule)
+    outbox_dispatcher.start()
+    scheduler.resume()
+
 
+async def on_demoted():
+    scheduler.pause()
+    deadline_scheduler.stop()
+    outbox_dispatcher.stop()
 
-async def send_notification(user_id, message):
-    await bot.send_message(user_id, message)
-    logging.info(f"Notification sent to user {user_id}: {message}")
 
+async def sync_deadline_scheduler():
+    # Встречи, назначенные через другие экземпляры бота, попадают в таймер лидера отсюда
+    deadline_scheduler.sync(await db.get_appointment_schedule())
 
+
+NOTIFICATION_MESSAGES = {
+    "6_days": "Напоминалка: Через 6 дней пройдет наша следующая встреча.",
+    "4_days": "Напоминалка: Встреча пройдет через 4 дня.",
+    "1_day": "Напоминалка: Встреча будет уже завтра. Не забудь повторить материал.",
+    "1_hour": "Напоминалка: В {time} у тебя встреча.",
+    "1_hour_after": "Встреча подходит к концу {time}."
+}
+
+
+@timed_job('check_for_notifications')
 async def check_for_notifications():
     logging.info("Checking for notifications...")
     now = datetime.now(pytz.timezone("Europe/Moscow"))
-    users = db.get_all_users()
-    logging.debug(f"Found {len(users)} users")
-
-    weekday_map = {
-        "Понедельник": 0,
-        "Вторник": 1,
-        "Среда": 2,
-        "Четверг": 3,
-        "Пятница": 4,
-        "Суббота": 5,
-        "Воскресение": 6
-    }
-
-    for user in users:
-        user_id = user['user_id']
-        appointments = db.get_user_appointments(user_id)
-        logging.debug(f"Found {len(appointments)} appointments for user {user_id}")
-
-        for appointment in appointments:
-            course_id = appointment['course_id']
-            appointment_day = weekday_map[appointment['weekday']]
-            appointment_time = datetime.strptime(appointment['time'], '%H:%M').time()
-            appointment_date = now.date() + timedelta(days=(appointment_day - now.weekday() + 7) % 7)
-            appointment_datetime = datetime.combine(appointment_date, appointment_time)
-            appointment_datetime = pytz.timezone("Europe/Moscow").localize(appointment_datetime)
-            time_diff = (appointment_datetime - now).total_seconds()
-
-            notification_types = [
-                (6 * 24 * 3600, "6_days"),
-                (4 * 24 * 3600, "4_days"),
-                (24 * 3600, "1_day"),
-                (1 * 3600, "1_hour"),
-                (-1 * 3600, "1_hour_after")
-            ]
-
-            for time_delta, notification_type in notification_types:
-                last_notification = db.get_last_notification(user_id, course_id, notification_type)
-                if (time_delta - 60 < time_diff < time_delta + 60) and (
-                        not last_notification or (now - last_notification).days >= 7):
-                    if notification_type == "6_days":
-                        await send_notification(user_id, f"Напоминалка: Через 6 дней пройдет наша следующая встреча.")
-                        db.update_notification_log(user_id, course_id, notification_type, now)
-                    elif notification_type == "4_days":
-                        await send_notification(user_id, f"Напоминалка: Встреча пройдет через 4 дня.")
-                        db.update_notification_log(user_id, course_id, notification_type, now)
-                    elif notification_type == "1_day":
-                        await send_notification(user_id,
-                                                f"Напоминалка: Встреча будет уже завтра. Не забудь повторить материал.")
-                        db.update_notification_log(user_id, course_id, notification_type, now)
-                    elif notification_type == "1_hour":
-                        await send_notification(user_id,
-                                                f"Напоминалка: В {appointment['time']} у тебя встреча.")
-                        db.update_notification_log(user_id, course_id, notification_type, now)
-                    elif notification_type == "1_hour_after":
-                        await send_notification(user_id,
-                                                f"Встреча подходит к концу {appointment['time']}.")
-                        db.update_notification_log(user_id, course_id, notification_type, now)
-                        db.update_week_number(course_id, user_id)
-                        await send_skills_notification(user_id, course_id)
-                        db.update_notification_log(user_id, course_id, notification_type, now)
-
-
-async def send_skills_notification(user_id, course_id):
-    if not db.has_sent_skills_notification(user_id, course_id):
-
-        current_week = db.get_current_week(course_id, user_id)
-        skills = db.get_skills_for_week(course_id, current_week)
-
-        if skills:
-            skills_message = "Информация для изучения на этой неделе:\n" + "\n".join(
-                [f"{skill['skill']}: {skill['link']}" for skill in skills])
-            await send_notification(user_id, skills_message)
-            db.record_skills_notification(user_id, course_id)
+    due_notifications = await db.get_due_notifications(now)
+    logging.debug(f"Found {len(due_notifications)} due notifications")
+    await enqueue_notifications(due_notifications, now)
+
+
+async def deliver_notification(notification, now):
+    await enqueue_notifications([notification], now)
+
+
+async def enqueue_notifications(notifications, now):
+    # Напоминания не отправляются здесь: они забираются и кладутся в очередь одной транзакцией,
+    # доставляет их outbox_dispatcher. При нескольких экземплярах каждое попадет в очередь один раз
+    if not notifications:
+        return
+    enqueued = await db.enqueue_notifications(
+        [(n['user_id'], n['course_id'], n['notification_type'],
+          NOTIFICATION_MESSAGES[n['notification_type']].format(time=n['time'])) for n in notifications], now)
+    if enqueued:
+        outbox_dispatcher.wake()
+
+
+@timed_job('purge_notification_outbox')
+async def purge_notification_outbox():
+    deleted = await db.purge_outbox(datetime.now() - timedelta(days=OUTBOX_RETENTION_DAYS))
+    logging.info(f"Purged {deleted} old notification outbox records")
+
+
+deadline_scheduler = DeadlineScheduler(pytz.timezone("Europe/Moscow"), deliver_notification)
+outbox_dispatcher = OutboxDispatcher(db, broadcaster)
+election = LeaderElection(db, on_elected=on_elected, on_demoted=on_demoted)
+
+
+@timed_job('send_skills_digests')
+async def send_skills_digests():
+    # Получатели группируются по (курс, неделя): текст подборки собирается один раз на когорту
+    cohorts = {}
+    for recipient in await db.get_due_skills_digests():
+        cohorts.setdefault((recipient['course_id'], recipient['week']), []).append(recipient['user_id'])
+
+    for (course_id, week), user_ids in cohorts.items():
+        skills = await week_skills.get(course_id, week)
+        if not skills:
+            continue
+        skills_message = "Информация для изучения на этой неделе:\n" + "\n".join(
+            [f"{skill['skill']}: {skill['link']}" for skill in skills])
+        statuses = await broadcaster.send_many(user_ids, skills_message)
+        # Недоступные получатели (бот заблокирован и т.п.) тоже отмечаются, чтобы не повторять им отправку
+        # каждый запуск; после временных ошибок подборка уйдет при следующем запуске
+        done = [user_id for user_id, status in statuses.items() if status in (SENT, UNREACHABLE)]
+        await db.record_skills_notifications([(user_id, course_id, week) for user_id in done])
+        delivered = sum(status == SENT for status in statuses.values())
+        logging.info(f"Skills digest for course {course_id}, week {week}: "
+                     f"{delivered} of {len(user_ids)} delivered, {len(user_ids) - len(done)} to retry")
+
+
+@timed_job('resync_course_skills')
+async def resync_course_skills():
+    loop = asyncio.get_running_loop()
+    courses_by_url = {}
+    for course in await db.get_courses_for_sync():
+        courses_by_url.setdefault(course['google_sheet_url'], []).append(course)
+
+    # Ошибка одной таблицы (доступ, учетные данные, сеть) не должна останавливать синхронизацию остальных
+    for google_sheet_url, courses in courses_by_url.items():
+        try:
+            await resync_spreadsheet(loop, google_sheet_url, courses)
+        except Exception:
+            logging.exception(f"Google Sheets resync failed: {google_sheet_url}")
+
+
+async def resync_spreadsheet(loop, google_sheet_url, courses):
+    modified_time = await loop.run_in_executor(
+        import_executor, get_spreadsheet_modified_time, google_sheet_url, CREDENTIALS_FILE)
+    # Таблица не менялась с прошлой синхронизации - ничего не делаем
+    if modified_time and all(course['sheet_modified_time'] == modified_time for course in courses):
+        return
+    # Листы разбираются лениво: строки идут из парсера прямо в sync_skills
+    skills_data = await loop.run_in_executor(
+        import_executor, functools.partial(parse_google_sheet, google_sheet_url, CREDENTIALS_FILE, lazy=True))
+    if not skills_data:
+        logging.warning(f"Google Sheets resync returned no data: {google_sheet_url}")
+        return
+
+    for course in courses:
+        if course['course_name'] not in skills_data:
+            logging.warning(f"Sheet for course {course['id']} ({course['course_name']}) not found")
+            continue
+        upserted, deleted = await db.sync_skills(course['id'], course['course_name'],
+                                                 skills_data[course['course_name']], modified_time)
+        logging.info(f"Course {course['id']} skills synced: {upserted} upserted, {deleted} deleted")
 
 
 # endregion
@@ -124,6 +209,7 @@ class Form(StatesGroup):
 
 class AddCourse(StatesGroup):
     waiting_for_google_sheet_url = State()
+    waiting_for_import = State()
     waiting_for_course_password = State()
     waiting_for_registration_deadline = State()
 
@@ -158,15 +244,28 @@ class SetRules(StatesGroup):
     waiting_for_rules_value = State()
 
 
+# region Cancel
+# Регистрируется первым, чтобы выйти можно было из любого состояния
+@dp.message_handler(commands=['cancel'], state='*')
+async def cancel_command(message: types.Message, state: FSMContext):
+    if await state.get_state() is None:
+        await message.answer("Нечего отменять.")
+        return
+    await state.finish()
+    await message.answer("Действие отменено.")
+
+
+# endregion
+
 # region Registration
 @dp.message_handler(commands=['start'])
-async def start(message: types.Message):
-    if not db.user_exists(message.from_user.id):
-        db.add_user(message.from_user.id)
+async def start(message: types.Message, profile):
+    if not profile:
+        await db.add_user(message.from_user.id)
         await bot.send_message(message.from_user.id, "Привет! Введи свой никнейм.")
         await Form.nickname.set()
     else:
-        rules = db.get_rules(message.from_user.id)
+        rules = profile['rules']
         if rules == 0:
             await bot.send_message(message.from_user.id, "Привет!", reply_markup=navigation.MainMenu)
         elif rules == 1:
@@ -181,8 +280,8 @@ async def set_nickname(message: types.Message, state: FSMContext):
     if len(nickname) > 63:
         await bot.send_message(message.from_user.id, "Ник слишком длинный")
     else:
-        db.set_nickname(message.from_user.id, nickname)
-        db.set_signup(message.from_user.id, 'done')
+        await db.set_nickname(message.from_user.id, nickname)
+        await db.set_signup(message.from_user.id, 'done')
         await bot.send_message(message.from_user.id, f"Установлен ник: {nickname}", reply_markup=navigation.Resizer)
         await state.finish()
 
@@ -190,8 +289,8 @@ async def set_nickname(message: types.Message, state: FSMContext):
 # endregion
 
 @dp.message_handler(commands=['Menu'])
-async def menu(message: types.Message):
-    rules = db.get_rules(message.from_user.id)
+async def menu(message: types.Message, profile):
+    rules = user_rules_of(profile)
     if rules == 0:
         await bot.send_message(message.from_user.id, "Панель юзера!", reply_markup=navigation.MainMenu)
     elif rules == 1:
@@ -201,27 +300,126 @@ async def menu(message: types.Message):
 
 
 @dp.message_handler(commands=['getrules'])
-async def get_rules_command(message: types.Message):
-    rules = db.get_rules(message.from_user.id)
+async def get_rules_command(message: types.Message, profile):
+    rules = user_rules_of(profile)
     await bot.send_message(message.from_user.id, f"Your rules value is: {rules}")
 
 
+# region Search
+# Инлайн-поиск: выбранный результат отправляет в чат команду с ID (/setrules, /view_homework, /submit_homework)
+@dp.inline_handler(state='*')
+async def inline_search(inline_query: types.InlineQuery, profile):
+    user_rules = user_rules_of(profile)
+    user_id = inline_query.from_user.id
+    text = inline_query.query
+    results = []
+
+    if user_rules == 2:
+        for user in await db.search_users(text, SEARCH_LIMIT):
+            results.append(types.InlineQueryResultArticle(
+                id=f"user_{user['user_id']}",
+                title=f"{user['nickname'] or 'Без ника'} ({user['user_id']})",
+                description=f"Изменить правила, сейчас: {user['rules']}",
+                input_message_content=types.InputTextMessageContent(f"/setrules {user['user_id']}")))
+    if user_rules >= 1:
+        owner_id = user_id if user_rules == 1 else None
+        for course in await db.search_courses(text, owner_id=owner_id, limit=SEARCH_LIMIT):
+            results.append(types.InlineQueryResultArticle(
+                id=f"view_course_{course['id']}",
+                title=course['course_name'],
+                description="Домашние задания курса",
+                input_message_content=types.InputTextMessageContent(f"/view_homework {course['id']}")))
+    if profile:
+        for course in await db.search_courses(text, student_id=user_id, limit=SEARCH_LIMIT):
+            results.append(types.InlineQueryResultArticle(
+                id=f"submit_course_{course['id']}",
+                title=course['course_name'],
+                description="Сдать домашнее задание",
+                input_message_content=types.InputTextMessageContent(f"/submit_homework {course['id']}")))
+
+    # Telegram принимает не больше 50 результатов
+    await inline_query.answer(results[:50], cache_time=SEARCH_CACHE_TIME, is_personal=True)
+
+
+# endregion
+
+# region SetWeek
+# /setweek <ID пользователя> <ID курса> <неделя|auto> - вручную задать неделю курса ученику или вернуть календарную
+@dp.message_handler(commands=['setweek'])
+async def set_week_command(message: types.Message, profile):
+    user_rules = user_rules_of(profile)
+    if user_rules < 1:
+        await message.answer("У тебя нет прав для выполнения этой функции.")
+        return
+
+    args = message.get_args().split()
+    if len(args) != 3 or not (args[0].isdigit() and args[1].isdigit() and (args[2].isdigit() or args[2] == 'auto')):
+        await message.answer("Формат: /setweek <ID пользователя> <ID курса> <неделя или auto>")
+        return
+    user_id, course_id = int(args[0]), int(args[1])
+    week = None if args[2] == 'auto' else int(args[2])
+
+    if user_rules == 1 and not any(course['id'] == course_id
+                                   for course in await db.get_user_courses_as_owner(message.from_user.id)):
+        await message.answer("Это не твой курс.")
+        return
+    if not await db.set_week_override(user_id, course_id, week):
+        await message.answer("Пользователь не записан на этот курс.")
+        return
+    current_week = await db.get_current_week(course_id, user_id)
+    await message.answer(f"Текущая неделя пользователя {user_id} на курсе {course_id}: {current_week}.")
+
+
+# endregion
+
+# region DbStats
+# /dbstats - сводка профайлера запросов (DB_PROFILE = True), /dbstats reset - обнулить
+@dp.message_handler(commands=['dbstats'])
+async def db_stats_command(message: types.Message, profile):
+    if user_rules_of(profile) < 2:
+        await message.answer("У тебя нет прав для выполнения этой функции.")
+        return
+    if profiler is None:
+        await message.answer("Профилирование запросов выключено (DB_PROFILE в conf.py).")
+        return
+    if message.get_args() == 'reset':
+        profiler.reset()
+        await message.answer("Статистика запросов сброшена.")
+        return
+
+    report = profiler.report()
+    logging.info(f"Query profile:\n{report}")
+    for chunk in split_message(report, MESSAGE_LIMIT - len('<pre></pre>')):
+        await message.answer(f"<pre>{quote_html(chunk)}</pre>", parse_mode=types.ParseMode.HTML)
+
+
+# endregion
+
 # region SetRules
-@dp.message_handler(commands=['setrules'])
-async def set_rules_command(message: types.Message):
-    user_rules = db.get_rules(message.from_user.id)
+# Команда работает и из выбора пользователя: результат инлайн-поиска присылает /setrules <ID> в этом состоянии
+@dp.message_handler(commands=['setrules'], state=[None, SetRules])
+async def set_rules_command(message: types.Message, state: FSMContext, profile):
+    await state.finish()
+    user_rules = user_rules_of(profile)
     if user_rules == 2:
-        users = db.get_users()
+        # /setrules <ID> - сразу к выбору значения (так работает выбор пользователя через инлайн-поиск)
+        args = message.get_args()
+        if args.isdigit():
+            await ask_rules_value(message.from_user.id, int(args), state)
+            return
+
+        users = await db.get_users(limit=10)
         if not users:
             await message.answer("Нет доступных пользователей.")
             return
 
         keyboard = InlineKeyboardMarkup(row_width=1)
-        for user in users[:10]:
+        for user in users:
             user_id = user['user_id']
             nickname = user['nickname'] or "Без ника"
             button_text = f"{user_id} - {nickname}"
             keyboard.add(InlineKeyboardButton(button_text, callback_data=f"setrules_user_{user_id}"))
+        keyboard.add(InlineKeyboardButton("Поиск по нику или ID", switch_inline_query_current_chat=""))
 
         await message.answer("Выберите пользователя для изменения правил:", reply_markup=keyboard)
         await SetRules.waiting_for_user_selection.set()
@@ -232,16 +430,19 @@ async def set_rules_command(message: types.Message):
 @dp.callback_query_handler(lambda c: c.data.startswith('setrules_user_'), state=SetRules.waiting_for_user_selection)
 async def user_selected(callback_query: types.CallbackQuery, state: FSMContext):
     user_id = int(callback_query.data.split('_')[2])
+    await ask_rules_value(callback_query.from_user.id, user_id, state)
+    await callback_query.answer()
+
+
+async def ask_rules_value(chat_id, user_id, state):
     await state.update_data(user_id=user_id)
 
     keyboard = InlineKeyboardMarkup(row_width=3)
     for rules_value in [0, 1, 2]:
         keyboard.add(InlineKeyboardButton(str(rules_value), callback_data=f"setrules_value_{rules_value}"))
 
-    await bot.send_message(callback_query.from_user.id, "Выберите новое значение правил для пользователя:",
-                           reply_markup=keyboard)
+    await bot.send_message(chat_id, "Выберите новое значение правил для пользователя:", reply_markup=keyboard)
     await SetRules.waiting_for_rules_value.set()
-    await callback_query.answer()
 
 
 @dp.callback_query_handler(lambda c: c.data.startswith('setrules_value_'), state=SetRules.waiting_for_rules_value)
@@ -250,7 +451,7 @@ async def rules_value_selected(callback_query: types.CallbackQuery, state: FSMCo
     data = await state.get_data()
     user_id = data.get('user_id')
 
-    db.set_rules(user_id, rules_value)
+    await db.set_rules(user_id, rules_value)
     await bot.send_message(callback_query.from_user.id,
                            f"Значение правил для пользователя {user_id} успешно обновлено до {rules_value}.")
     await state.finish()
@@ -261,8 +462,8 @@ async def rules_value_selected(callback_query: types.CallbackQuery, state: FSMCo
 
 # region AddCourse
 @dp.message_handler(commands=['addcourse'])
-async def add_course_command(message: types.Message):
-    user_rules = db.get_rules(message.from_user.id)
+async def add_course_command(message: types.Message, profile):
+    user_rules = user_rules_of(profile)
     if user_rules >= 1:
         await bot.send_message(message.from_user.id, "Введи Google Sheets URL.")
         await AddCourse.waiting_for_google_sheet_url.set()
@@ -274,28 +475,52 @@ async def add_course_command(message: types.Message):
 async def add_google_sheet_url(message: types.Message, state: FSMContext):
     google_sheet_url = message.text
     await state.update_data(google_sheet_url=google_sheet_url)
+    await AddCourse.waiting_for_import.set()
+    await bot.send_message(message.from_user.id, "Загружаю Google Sheets, это может занять время...")
 
-    # Parse the Google Sheet and add skills data
-    skills_data = parse_google_sheet(google_sheet_url, CREDENTIALS_FILE)
-    if not skills_data:
+    # Таблица парсится в фоне, чтобы бот не зависал для остальных пользователей
+    task = asyncio.create_task(import_google_sheet(message, state, google_sheet_url))
+    import_tasks.add(task)
+    task.add_done_callback(import_tasks.discard)
+
+
+async def import_google_sheet(message: types.Message, state: FSMContext, google_sheet_url):
+    # Здесь нужны только названия курсов: они берутся из метаданных таблицы без ячеек. Каждый лист
+    # читается один раз и потоком пишется в базу при сохранении курса (add_registration_deadline)
+    try:
+        course_names = await asyncio.get_running_loop().run_in_executor(
+            import_executor, get_sheet_titles, google_sheet_url, CREDENTIALS_FILE)
+    except Exception:
+        logging.exception(f"Google Sheets import failed: {google_sheet_url}")
+        course_names = []
+
+    if await state.get_state() != AddCourse.waiting_for_import.state:
+        # Пользователь отменил загрузку (/cancel), пока таблица парсилась
+        return
+    if not course_names:
         await bot.send_message(message.from_user.id,
                                "Failed to parse the Google Sheets. Please check the URL and try again.")
         await state.finish()
         return
 
-    await state.update_data(skills_data=skills_data)
+    await state.update_data(course_names=course_names)
     await bot.send_message(message.from_user.id, "Курсы с Google Sheets загружены! Введи пароли для каждого из них.")
     await state.update_data(current_course_index=0)
     await request_next_course_details(message, state)
 
 
+@dp.message_handler(state=AddCourse.waiting_for_import)
+async def import_in_progress(message: types.Message):
+    await bot.send_message(message.from_user.id, "Таблица еще загружается, подожди немного. Отменить: /cancel")
+
+
 async def request_next_course_details(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    skills_data = data['skills_data']
+    course_names = data['course_names']
     current_course_index = data['current_course_index']
 
-    if current_course_index < len(skills_data):
-        course_name = list(skills_data.keys())[current_course_index]
+    if current_course_index < len(course_names):
+        course_name = course_names[current_course_index]
         await bot.send_message(message.from_user.id, f"Пожалуйста, введи пароль для курса: {course_name}")
         await AddCourse.waiting_for_course_password.set()
     else:
@@ -307,9 +532,7 @@ async def request_next_course_details(message: types.Message, state: FSMContext)
 async def add_course_password(message: types.Message, state: FSMContext):
     data = await state.get_data()
     current_course_index = data['current_course_index']
-    skills_data = data['skills_data']
-
-    course_name = list(skills_data.keys())[current_course_index]
+    course_name = data['course_names'][current_course_index]
     password = message.text
     await state.update_data(password=password)
 
@@ -330,13 +553,23 @@ async def add_registration_deadline(message: types.Message, state: FSMContext):
     data = await state.get_data()
     current_course_index = data['current_course_index']
     google_sheet_url = data['google_sheet_url']
-    skills_data = data['skills_data']
     password = data['password']
+    course_name = data['course_names'][current_course_index]
 
-    course_name = list(skills_data.keys())[current_course_index]
-    course_id = db.add_course(course_name, message.from_user.id, password, registration_deadline, google_sheet_url)
+    # Лист читается до создания курса, чтобы при ошибке не остался курс без навыков
+    try:
+        skills = await asyncio.get_running_loop().run_in_executor(
+            import_executor, iter_sheet_skills, google_sheet_url, CREDENTIALS_FILE, course_name)
+    except Exception:
+        logging.exception(f"Failed to read sheet {course_name}: {google_sheet_url}")
+        skills = None
+    if skills is None:
+        await bot.send_message(message.from_user.id,
+                               f"Не удалось прочитать лист {course_name}. Пришли дату еще раз или /cancel")
+        return
 
-    db.add_skills(course_id, course_name, skills_data[course_name])
+    course_id = await db.add_course(course_name, message.from_user.id, password, registration_deadline, google_sheet_url)
+    await db.add_skills(course_id, course_name, skills)
 
     await state.update_data(current_course_index=current_course_index + 1)
     await request_next_course_details(message, state)
@@ -347,7 +580,7 @@ async def add_registration_deadline(message: types.Message, state: FSMContext):
 # region courses
 @dp.message_handler(commands=['courses'])
 async def list_courses(message: types.Message):
-    courses = db.get_courses()
+    courses = await db.get_courses()
     if courses:
         response = "Доступные курсы:\n"
         for course in courses:
@@ -357,9 +590,9 @@ async def list_courses(message: types.Message):
         await bot.send_message(message.from_user.id, "На данный момент нет свободных курсов для регистрации.")
 
 
-def get_open_courses():
+async def get_open_courses():
     open_courses = []
-    courses = db.get_courses()
+    courses = await db.get_courses()
     current_date = datetime.now().date()
     for course in courses:
         registration_deadline = datetime.strptime(course[2], '%Y-%m-%d').date()
@@ -386,7 +619,7 @@ def generate_course_keyboard(courses, page=0):
 # region Enroll
 @dp.message_handler(commands=['enroll'])
 async def enroll_command(message: types.Message):
-    open_courses = get_open_courses()
+    open_courses = await get_open_courses()
     if open_courses:
         keyboard = generate_course_keyboard(open_courses)
         await bot.send_message(message.from_user.id, "Выбери курс для записи:", reply_markup=keyboard)
@@ -400,7 +633,7 @@ async def enroll_command(message: types.Message):
                            state=EnrollCourse.waiting_for_course_selection)
 async def paginate_courses(callback_query: CallbackQuery, state: FSMContext):
     page = int(callback_query.data.split('_')[-1])
-    open_courses = get_open_courses()
+    open_courses = await get_open_courses()
     keyboard = generate_course_keyboard(open_courses, page)
     await bot.edit_message_reply_markup(callback_query.from_user.id, callback_query.message.message_id,
                                         reply_markup=keyboard)
@@ -422,10 +655,10 @@ async def enroll_course(message: types.Message, state: FSMContext):
     password = message.text
     data = await state.get_data()
     course_id = data['course_id']
-    course_password = db.get_course_password(course_id)
+    course_password = await db.get_course_password(course_id)
 
     if course_password == password:
-        db.enroll_user(message.from_user.id, course_id)
+        await db.enroll_user(message.from_user.id, course_id)
         await bot.send_message(message.from_user.id, "Поздравляем! Ты записан на курс")
         await state.finish()
     else:
@@ -437,54 +670,86 @@ async def enroll_course(message: types.Message, state: FSMContext):
 
 # region Appointment
 @dp.message_handler(commands=['set_appointment'])
-async def set_appointment_command(message: types.Message):
-    user_rules = db.get_rules(message.from_user.id)
+async def set_appointment_command(message: types.Message, profile):
+    user_rules = user_rules_of(profile)
     if user_rules >= 1:
-        users = db.get_users_without_appointments()
-        if not users:
-            await message.reply("Нет пользователей без назначенных встреч.")
+        text, markup = await student_selection(message.from_user.id, user_rules)
+        if markup is None:
+            await message.reply(text)
             return
 
-        await show_user_selection(message.from_user.id, users, 0)
+        await bot.send_message(message.from_user.id, text, reply_markup=markup)
         await SetAppointment.waiting_for_user_selection.set()
     else:
         await message.reply("У тебя нет прав для выполнения этой функции.")
 
 
-async def show_user_selection(user_id, users, start_index):
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    for user in users[start_index:start_index + 10]:
-        markup.insert(types.InlineKeyboardButton(user[1], callback_data=f"user_{user[0]}"))
-
-    if start_index + 10 < len(users):
-        markup.add(types.InlineKeyboardButton("Вперед", callback_data=f"next_{start_index + 10}"))
+async def student_selection(teacher_id, user_rules, after_id=None, before_id=None):
+    # Преподаватель видит учеников своих курсов, админ - всех; страницы листаются по id записи на курс
+    owner_id = teacher_id if user_rules == 1 else None
+    students = await db.get_students_without_appointments(owner_id, after_id, before_id, STUDENTS_PAGE_SIZE)
+    has_more = len(students) > STUDENTS_PAGE_SIZE
+    students = students[:STUDENTS_PAGE_SIZE]
+    if before_id is not None:
+        students = students[::-1]
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, after_id is not None
 
-    if start_index > 0:
-        markup.add(types.InlineKeyboardButton("Назад", callback_data=f"prev_{start_index - 10}"))
+    if not students:
+        return "Нет пользователей без назначенных встреч.", None
 
-    await bot.send_message(user_id, "Выбери пользователя:", reply_markup=markup)
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for student in students:
+        # Без ника ученик показывается по Telegram ID
+        name = student['nickname'] or student['user_id']
+        markup.insert(types.InlineKeyboardButton(f"{name} ({student['course_name']})",
+                                                 callback_data=f"user_{student['id']}"))
+    navigation_row = []
+    if has_prev:
+        navigation_row.append(types.InlineKeyboardButton("Назад", callback_data=f"prev_{students[0]['id']}"))
+    if has_next:
+        navigation_row.append(types.InlineKeyboardButton("Вперед", callback_data=f"next_{students[-1]['id']}"))
+    if navigation_row:
+        markup.row(*navigation_row)
+    return "Выбери пользователя:", markup
 
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith('user_'),
                            state=SetAppointment.waiting_for_user_selection)
-async def process_user_selection(callback_query: types.CallbackQuery, state: FSMContext):
-    user_id = int(callback_query.data.split('_')[1])
-    await state.update_data(selected_user=user_id)
+async def process_user_selection(callback_query: types.CallbackQuery, state: FSMContext, profile):
+    enrollment = await db.get_enrollment(int(callback_query.data.split('_')[1]))
+    if enrollment is None or (user_rules_of(profile) == 1 and enrollment['owner_id'] != callback_query.from_user.id):
+        await callback_query.answer("Запись на курс не найдена.")
+        return
+    await state.update_data(selected_user=enrollment['user_id'], course_id=enrollment['course_id'])
     await bot.send_message(callback_query.from_user.id, "Введи день недели (например, Понедельник).")
     await SetAppointment.waiting_for_weekday.set()
+    await callback_query.answer()
 
 
 @dp.callback_query_handler(lambda c: c.data and (c.data.startswith('next_') or c.data.startswith('prev_')),
                            state=SetAppointment.waiting_for_user_selection)
-async def process_pagination(callback_query: types.CallbackQuery, state: FSMContext):
-    start_index = int(callback_query.data.split('_')[1])
-    users = db.get_users_without_appointments()
-    await show_user_selection(callback_query.from_user.id, users, start_index)
+async def process_pagination(callback_query: types.CallbackQuery, state: FSMContext, profile):
+    direction, cursor = callback_query.data.split('_')
+    cursor = int(cursor)
+    if direction == 'next':
+        text, markup = await student_selection(callback_query.from_user.id, user_rules_of(profile), after_id=cursor)
+    else:
+        text, markup = await student_selection(callback_query.from_user.id, user_rules_of(profile), before_id=cursor)
+    # Страница заменяет клавиатуру в том же сообщении
+    await callback_query.message.edit_text(text, reply_markup=markup)
+    await callback_query.answer()
 
 
 @dp.message_handler(state=SetAppointment.waiting_for_weekday)
 async def process_weekday(message: types.Message, state: FSMContext):
-    weekday = message.text
+    # Без распознанного дня у встречи не будет minute_of_week и напоминания не придут
+    weekday = message.text.strip().capitalize()
+    if weekday not in WEEKDAYS:
+        await bot.send_message(message.from_user.id,
+                               "Не понял день недели. Напиши его полностью, например: Понедельник.")
+        return
     await state.update_data(weekday=weekday)
     await bot.send_message(message.from_user.id, "Введи время встречи (например, 15:00).")
     await SetAppointment.waiting_for_time.set()
@@ -492,13 +757,21 @@ async def process_weekday(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=SetAppointment.waiting_for_time)
 async def process_time(message: types.Message, state: FSMContext):
-    time = message.text
+    time = message.text.strip()
+    try:
+        datetime.strptime(time, '%H:%M')
+    except ValueError:
+        await bot.send_message(message.from_user.id, "Неверный формат времени. Нужно так: ЧЧ:ММ, например 15:00.")
+        return
     data = await state.get_data()
     teacher_id = message.from_user.id
     user_id = data['selected_user']
+    course_id = data['course_id']
     weekday = data['weekday']
 
-    db.add_appointment(teacher_id, user_id, weekday, time)
+    appointment_id = await db.add_appointment(teacher_id, user_id, course_id, weekday, time)
+    if deadline_scheduler.running:
+        deadline_scheduler.add_appointment(await db.get_appointment(appointment_id))
     await bot.send_message(message.from_user.id, "Напоминания для встречи установлены!")
     await state.finish()
 
@@ -506,18 +779,29 @@ async def process_time(message: types.Message, state: FSMContext):
 # endregion
 
 # region Homework
-@dp.message_handler(commands=['submit_homework'])
-async def submit_homework_command(message: types.Message):
+@dp.message_handler(commands=['submit_homework'], state=[None, SubmitHomework])
+async def submit_homework_command(message: types.Message, state: FSMContext):
+    await state.finish()
     user_id = message.from_user.id
-    courses = db.get_user_courses(user_id)
+    courses = await db.get_user_courses(user_id)
 
     if not courses:
         await message.answer("Вы не зарегистрированы ни на один курс.")
         return
 
+    # /submit_homework <ID курса> - курс уже выбран через инлайн-поиск
+    args = message.get_args()
+    if args.isdigit() and any(course['id'] == int(args) for course in courses):
+        await state.update_data(course_id=int(args))
+        await message.answer("Отправьте ссылку на домашнюю работу.")
+        await SubmitHomework.waiting_for_homework_link.set()
+        return
+
     keyboard = InlineKeyboardMarkup(row_width=1)
     for course in courses[:10]:  # Показать до 10 курсов
         keyboard.add(InlineKeyboardButton(course['course_name'], callback_data=f"select_course_{course['id']}"))
+    if len(courses) > 10:
+        keyboard.add(InlineKeyboardButton("Поиск курса", switch_inline_query_current_chat=""))
 
     await message.answer("Выберите курс для отправки домашней работы:", reply_markup=keyboard)
     await SubmitHomework.waiting_for_course_selection.set()
@@ -539,21 +823,27 @@ async def handle_homework_link(message: types.Message, state: FSMContext):
     course_id = data['course_id']
     file_link = message.text
 
-    db.submit_homework(message.from_user.id, course_id, file_link)
+    await db.submit_homework(message.from_user.id, course_id, file_link)
     await message.answer("Ссылка на домашнюю работу успешно отправлена!")
     await state.finish()
 
 
 # Command to view homework submissions
-@dp.message_handler(commands=['view_homework'])
-async def view_homework_command(message: types.Message):
-    user_rules = db.get_rules(message.from_user.id)
+@dp.message_handler(commands=['view_homework'], state=[None, ViewHomework])
+async def view_homework_command(message: types.Message, state: FSMContext, profile):
+    await state.finish()
+    user_rules = user_rules_of(profile)
 
     if user_rules >= 1:
+        args = message.get_args()
+        if args.isdigit() and await can_view_homework(message.from_user.id, profile, int(args)):
+            await show_homework_page(message.from_user.id, int(args))
+            return
+
         if user_rules == 1:
-            courses = db.get_user_courses_as_owner(message.from_user.id)
+            courses = await db.get_user_courses_as_owner(message.from_user.id)
         else:
-            courses = db.get_all_courses()
+            courses = await db.get_all_courses()
 
         if not courses:
             await message.answer("Нет доступных курсов.")
@@ -562,6 +852,8 @@ async def view_homework_command(message: types.Message):
         keyboard = InlineKeyboardMarkup(row_width=1)
         for course in courses[:10]:
             keyboard.add(InlineKeyboardButton(course['course_name'], callback_data=f"view_course_{course['id']}"))
+        if len(courses) > 10:
+            keyboard.add(InlineKeyboardButton("Поиск курса", switch_inline_query_current_chat=""))
 
         await message.answer("Выберите курс для просмотра домашних заданий:", reply_markup=keyboard)
         await ViewHomework.waiting_for_course_selection.set()
@@ -572,29 +864,71 @@ async def view_homework_command(message: types.Message):
 @dp.callback_query_handler(lambda c: c.data.startswith('view_course_'), state=ViewHomework.waiting_for_course_selection)
 async def course_selected(callback_query: types.CallbackQuery, state: FSMContext):
     course_id = int(callback_query.data.split('_')[2])
-    await state.update_data(course_id=course_id)
+    await state.finish()
+    await show_homework_page(callback_query.from_user.id, course_id)
+    await callback_query.answer()
 
-    homework = db.get_last_homework(course_id)
-    if homework:
-        response = "Последние 50 домашних заданий:\n"
-        for hw in homework:
-            user_nickname = db.get_nickname(hw[0])
-            response += f"{user_nickname} - {hw[1]}\n"
-        await bot.send_message(callback_query.from_user.id, response)
-    else:
-        await bot.send_message(callback_query.from_user.id, "Для этого курса нет домашних заданий.")
 
-    await state.finish()
+# Листание: hw_older_<курс>_<id последней работы на странице>, hw_newer_<курс>_<id первой работы>
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith(('hw_older_', 'hw_newer_')), state='*')
+async def paginate_homework(callback_query: types.CallbackQuery, profile):
+    _, direction, course_id, cursor = callback_query.data.split('_')
+    course_id, cursor = int(course_id), int(cursor)
+    if not await can_view_homework(callback_query.from_user.id, profile, course_id):
+        await callback_query.answer("У вас нет прав для просмотра домашних заданий.")
+        return
+    if direction == 'older':
+        await show_homework_page(callback_query.from_user.id, course_id, before_id=cursor)
+    else:
+        await show_homework_page(callback_query.from_user.id, course_id, after_id=cursor)
     await callback_query.answer()
 
 
+async def can_view_homework(user_id, profile, course_id):
+    user_rules = user_rules_of(profile)
+    if user_rules == 1:
+        return any(course['id'] == course_id for course in await db.get_user_courses_as_owner(user_id))
+    return user_rules >= 2
+
+
+async def show_homework_page(chat_id, course_id, before_id=None, after_id=None):
+    rows = await db.get_homework_page(course_id, before_id, after_id, HOMEWORK_PAGE_SIZE)
+    has_more = len(rows) > HOMEWORK_PAGE_SIZE
+    rows = rows[:HOMEWORK_PAGE_SIZE]
+    if after_id is not None:
+        rows = rows[::-1]
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = before_id is not None, has_more
+
+    if not rows:
+        await bot.send_message(chat_id, "Для этого курса нет домашних заданий.")
+        return
+
+    response = "Домашние задания:\n"
+    for hw in rows:
+        submitted_at = hw['submitted_at'][:16].replace('T', ' ')
+        response += f"{submitted_at} {hw['nickname']} - {hw['file_link']}\n"
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    if has_newer:
+        keyboard.insert(InlineKeyboardButton("Новее", callback_data=f"hw_newer_{course_id}_{rows[0]['id']}"))
+    if has_older:
+        keyboard.insert(InlineKeyboardButton("Старше", callback_data=f"hw_older_{course_id}_{rows[-1]['id']}"))
+
+    # Ссылки могут быть длинными: ответ делится на сообщения в пределах лимита Telegram
+    chunks = split_message(response)
+    for chunk in chunks[:-1]:
+        await bot.send_message(chat_id, chunk, disable_web_page_preview=True)
+    await bot.send_message(chat_id, chunks[-1], reply_markup=keyboard, disable_web_page_preview=True)
+
+
 # endregion
 
 
 # region Announcement
 @dp.message_handler(commands=['send_announcement'])
-async def send_announcement_command(message: types.Message):
-    user_rules = db.get_rules(message.from_user.id)
+async def send_announcement_command(message: types.Message, profile):
+    user_rules = user_rules_of(profile)
     if user_rules >= 1:
         await bot.send_message(message.from_user.id, "Введи ID Курса и сообщение, которое хочешь отправить.")
         await SendAnnouncement.waiting_for_announcement_details.set()
@@ -610,18 +944,79 @@ async def send_announcement_details(message: types.Message, state: FSMContext):
         return
 
     course_id, announcement = int(details[0]), details[1]
-    enrolled_users = db.get_enrolled_users(course_id)
-
-    for user in enrolled_users:
-        await bot.send_message(user[0], f"Сообщение для курса {course_id}: {announcement}")
+    enrolled_users = await db.get_enrolled_users(course_id)
 
-    await bot.send_message(message.from_user.id, "Уведомление отправленно!")
+    broadcaster.start(message.from_user.id, [user[0] for user in enrolled_users],
+                      f"Сообщение для курса {course_id}: {announcement}")
     await state.finish()
 
 
 # endregion
 
 
-if __name__ == '__main__':
+# Общие для polling и webhook хуки запуска и остановки
+async def on_startup(dp):
+    await reset_interrupted_imports()
     schedule_notifications()
-    executor.start_polling(dp, skip_updates=True)
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT)
+
+
+async def reset_interrupted_imports():
+    # Задачи загрузки таблиц не переживают перезапуск, а состояние waiting_for_import хранится в базе.
+    # С несколькими экземплярами не сбрасывается: загрузка может идти в другом (выход - /cancel)
+    if shared_state:
+        return
+    for chat, user in await dp.storage.reset_states([AddCourse.waiting_for_import]):
+        try:
+            await bot.send_message(chat, "Загрузка Google Sheets прервалась из-за перезапуска бота. "
+                                         "Начни заново: /addcourse")
+        except TelegramAPIError as e:
+            logging.warning(f"Failed to notify {chat} about interrupted import: {e}")
+
+
+async def on_startup_webhook(dp):
+    await on_startup(dp)
+    await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    logging.info(f"Webhook set to {WEBHOOK_URL + WEBHOOK_PATH}")
+
+
+async def on_shutdown(dp):
+    await election.stop()
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    deadline_scheduler.stop()
+    outbox_dispatcher.stop()
+    import_executor.shutdown(wait=False)
+    db.close()
+
+
+@web.middleware
+async def check_webhook_secret(request, handler):
+    # Telegram присылает WEBHOOK_SECRET в заголовке; запросы без него на путь вебхука отклоняются
+    if WEBHOOK_SECRET and request.path == WEBHOOK_PATH:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            raise web.HTTPUnauthorized()
+    return await handler(request)
+
+
+def start_webhook():
+    if not WEBHOOK_SECRET:
+        logging.warning("WEBHOOK_SECRET is not set, webhook requests are not authenticated")
+    # Без skip_updates: он удаляет вебхук, а при нескольких репликах это сорвет прием апдейтов у остальных
+    webhook_executor = executor.Executor(dp)
+    webhook_executor.on_startup(on_startup_webhook)
+    webhook_executor.on_shutdown(on_shutdown)
+    webhook_executor.set_webhook(WEBHOOK_PATH, web_app=web.Application(middlewares=[check_webhook_secret]))
+    webhook_executor.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
+
+
+if __name__ == '__main__':
+    if REPLICAS > 1 and BOT_MODE != 'webhook':
+        # getUpdates допускает только одного получателя апдейтов
+        raise SystemExit("REPLICAS > 1 requires BOT_MODE = 'webhook'")
+    if BOT_MODE == 'webhook':
+        start_webhook()
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,177 @@
+import bisect
+import logging
+import time
+from functools import wraps
+
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import TelegramAPIError
+from aiohttp import web
+
+# Метрики в текстовом формате Prometheus; сервер поднимается только если задан METRICS_PORT
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # значения меток -> [счетчики по корзинам (+Inf последней), сумма, количество]
+        self._values = {}
+
+    def observe(self, seconds, *label_values):
+        series = self._values.get(label_values)
+        if series is None:
+            series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+        series[2] += 1
+
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels + ('le',), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+UPDATES = Counter('bot_updates_total', 'Received updates', ['type'])
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Handler latency', ['handler'])
+DB_SECONDS = Histogram('bot_db_query_seconds', 'Database method latency', ['method'])
+JOB_SECONDS = Histogram('bot_scheduler_tick_seconds', 'Scheduler job duration', ['job'])
+API_SECONDS = Histogram('bot_api_request_seconds', 'Bot API request latency', ['method'])
+API_ERRORS = Counter('bot_api_errors_total', 'Failed Bot API requests', ['method', 'error'])
+NOTIFICATIONS = Counter('bot_notifications_total', 'Delivered reminders', ['type'])
+
+REGISTRY = [UPDATES, HANDLER_SECONDS, DB_SECONDS, JOB_SECONDS, API_SECONDS, API_ERRORS, NOTIFICATIONS]
+
+
+def expose():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+def timed_job(job):
+    # Декоратор для задач планировщика: длительность каждого запуска попадает в JOB_SECONDS
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with JOB_SECONDS.time(job):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MetricsBot(Bot):
+    # Все запросы к Bot API проходят через request: здесь меряется их время и считаются ошибки
+    async def request(self, method, data=None, files=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except TelegramAPIError as e:
+            API_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, method)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update, data):
+        # Тип апдейта - единственное поле, кроме update_id (message, callback_query, ...)
+        UPDATES.inc(next((key for key in update.to_python() if key != 'update_id'), 'unknown'))
+
+    async def _start(self, data):
+        handler = current_handler.get(None)
+        data['_metrics_handler'] = (getattr(handler, '__name__', 'unknown'), time.perf_counter())
+
+    async def _finish(self, data):
+        started = data.pop('_metrics_handler', None)
+        if started:
+            HANDLER_SECONDS.observe(time.perf_counter() - started[1], started[0])
+
+    async def on_process_message(self, message, data):
+        await self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        await self._finish(data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        await self._start(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        await self._finish(data)
+
+    async def on_process_inline_query(self, inline_query, data):
+        await self._start(data)
+
+    async def on_post_process_inline_query(self, inline_query, results, data):
+        await self._finish(data)
+
+
+async def handle_metrics(request):
+    return web.Response(text=expose(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(port, host='127.0.0.1'):
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics served on http://{host}:{port}/metrics")
+    return runner
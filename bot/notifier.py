@@ -0,0 +1,99 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta
+
+from db import NOTIFICATION_TYPES
+
+
+class DeadlineScheduler:
+    def __init__(self, timezone, callback):
+        self.timezone = timezone
+        self.callback = callback
+        self._heap = []
+        self._appointment_ids = set()
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def next_fire_time(self, minute_of_week, offset, after):
+        # after - aware datetime в self.timezone
+        local = after.astimezone(self.timezone).replace(tzinfo=None)
+        week_start = (local - timedelta(days=local.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+        fire_at = week_start + timedelta(minutes=minute_of_week - offset)
+        while fire_at <= local:
+            fire_at += timedelta(weeks=1)
+        while fire_at - timedelta(weeks=1) > local:
+            fire_at -= timedelta(weeks=1)
+        return self.timezone.localize(fire_at)
+
+    def add_appointment(self, appointment, now=None):
+        minute_of_week = appointment['minute_of_week']
+        if minute_of_week is None:
+            return
+        now = now or datetime.now(self.timezone)
+        self._appointment_ids.add(appointment['id'])
+        for offset, notification_type in NOTIFICATION_TYPES:
+            entry = {
+                'appointment_id': appointment['id'],
+                'user_id': appointment['user_id'],
+                'course_id': appointment['course_id'],
+                'time': appointment['time'],
+                'minute_of_week': minute_of_week,
+                'offset': offset,
+                'notification_type': notification_type
+            }
+            self._push(entry, self.next_fire_time(minute_of_week, offset, now))
+        self._wakeup.set()
+
+    def load(self, appointments):
+        now = datetime.now(self.timezone)
+        for appointment in appointments:
+            self.add_appointment(appointment, now)
+        logging.info(f"Deadline scheduler loaded {len(self._heap)} reminders")
+
+    def sync(self, appointments):
+        # Добавить встречи, созданные с момента загрузки (например, другим экземпляром бота)
+        now = datetime.now(self.timezone)
+        for appointment in appointments:
+            if appointment['id'] not in self._appointment_ids:
+                self.add_appointment(appointment, now)
+
+    def _push(self, entry, fire_at):
+        heapq.heappush(self._heap, (fire_at, next(self._counter), entry))
+
+    def start(self, loader=None):
+        self._task = asyncio.get_event_loop().create_task(self._run(loader))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        # Следующий start загрузит встречи заново
+        self._heap = []
+        self._appointment_ids = set()
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    async def _run(self, loader=None):
+        if loader:
+            self.load(await loader())
+        while True:
+            now = datetime.now(self.timezone)
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, _, entry = heapq.heappop(self._heap)
+                try:
+                    await self.callback(entry, now)
+                except Exception:
+                    logging.exception(f"Reminder {entry['notification_type']} for user {entry['user_id']} failed")
+                self._push(entry, self.next_fire_time(entry['minute_of_week'], entry['offset'], fire_at))
+
+            self._wakeup.clear()
+            timeout = (self._heap[0][0] - datetime.now(self.timezone)).total_seconds() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+
+from broadcast import FAILED, RETRY, SENT, UNREACHABLE
+from metrics import NOTIFICATIONS
+
+BATCH_SIZE = 50
+POLL_INTERVAL = 5
+# Паузы перед повторными попытками, с; после последней запись помечается 'failed'
+RETRY_DELAYS = (10, 30, 60, 300)
+ERRORS = {RETRY: 'flood control or network error', FAILED: 'rejected by Telegram', UNREACHABLE: 'chat unavailable'}
+
+
+class OutboxDispatcher:
+    # Доставляет напоминания из notification_outbox пачками через общие лимиты Broadcaster.
+    # Записи ставятся в очередь в той же транзакции, что и notification_log (Database.enqueue_notifications),
+    # поэтому после перезапуска недоставленные напоминания дойдут, а не потеряются и не задвоятся в логе
+    def __init__(self, db, broadcaster, batch_size=BATCH_SIZE, interval=POLL_INTERVAL, retry_delays=RETRY_DELAYS):
+        self.db = db
+        self.broadcaster = broadcaster
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_delays = retry_delays
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def wake(self):
+        # Новые записи в очереди: не ждать следующего опроса
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                processed = await self.dispatch()
+            except Exception:
+                logging.exception("Notification outbox dispatch failed")
+                processed = 0
+            if processed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def dispatch(self):
+        # Одна пачка: отправить, затем одной транзакцией записать статусы. Возвращает размер пачки
+        now = time.time()
+        batch = await self.db.get_outbox_batch(now, self.batch_size)
+        if not batch:
+            return 0
+        sent, retries, failed = [], [], []
+        # Устаревшие напоминания (долгий простой, затянувшиеся повторы) не отправляются
+        expired = {row['id'] for row in batch if row['expires_at'] is not None and row['expires_at'] < now}
+        failed.extend((outbox_id, 'expired') for outbox_id in expired)
+        batch = [row for row in batch if row['id'] not in expired]
+        results = await asyncio.gather(*(self._deliver(row) for row in batch))
+        for row, (status, error) in zip(batch, results):
+            if status == SENT:
+                sent.append(row['id'])
+                NOTIFICATIONS.inc(row['notification_type'])
+            elif status == RETRY and row['attempts'] < len(self.retry_delays):
+                next_attempt_at = time.time() + self.retry_delays[row['attempts']]
+                if row['expires_at'] is not None and next_attempt_at > row['expires_at']:
+                    failed.append((row['id'], f"{error}; expired before retry"))
+                else:
+                    retries.append((row['id'], error, next_attempt_at))
+            else:
+                failed.append((row['id'], error))
+        await self.db.complete_outbox(sent, retries, failed)
+        if retries or failed:
+            logging.warning(f"Outbox batch: {len(sent)} sent, {len(retries)} to retry, {len(failed)} failed "
+                            f"({len(expired)} expired)")
+        return len(batch) + len(expired)
+
+    async def _deliver(self, row):
+        try:
+            status = await self.broadcaster.attempt(row['user_id'], row['text'])
+        except Exception as e:
+            # Таймауты и обрывы соединения, которые aiogram не заворачивает в свои исключения
+            logging.warning(f"Failed to send notification {row['id']} to {row['user_id']}: {e!r}")
+            return RETRY, repr(e)
+        if status == SENT:
+            logging.info(f"Notification sent to user {row['user_id']}: {row['text']}")
+        return status, ERRORS.get(status)
@@ -1,8 +1,23 @@
+import functools
+import logging
+import random
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from googleapiclient.discovery import build
 from google.oauth2.service_account import Credentials
 from googleapiclient.errors import HttpError
 
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_WORKERS = 4
+# Белый фон: самый частый случай, отсекается одним сравнением словарей
+WHITE = {'red': 1, 'green': 1, 'blue': 1}
+
+_local = threading.local()
+
 
 def authorize_google_sheets(credentials_file):
     credentials = Credentials.from_service_account_file(credentials_file)
@@ -10,36 +25,134 @@ def authorize_google_sheets(credentials_file):
     return service
 
 
+def execute_with_backoff(request, retries=MAX_RETRIES):
+    # 429 и 5xx повторяем с экспоненциальной задержкой: 1, 2, 4, 8... секунд плюс случайный разброс
+    for attempt in range(retries + 1):
+        try:
+            return request.execute()
+        except HttpError as error:
+            if error.resp.status not in RETRY_STATUSES or attempt == retries:
+                raise
+            time.sleep(2 ** attempt + random.random())
+
+
+def get_thread_service(credentials_file):
+    # Клиент googleapiclient не потокобезопасен: у каждого потока свой
+    if getattr(_local, 'credentials_file', None) != credentials_file:
+        _local.service = authorize_google_sheets(credentials_file)
+        _local.drive = None
+        _local.credentials_file = credentials_file
+    return _local.service
+
+
+def get_thread_drive_service(credentials_file):
+    get_thread_service(credentials_file)
+    if _local.drive is None:
+        credentials = Credentials.from_service_account_file(credentials_file)
+        _local.drive = build('drive', 'v3', credentials=credentials)
+    return _local.drive
+
+
+def get_spreadsheet_modified_time(sheet_url, credentials_file):
+    # Время последнего изменения таблицы по Drive API; None, если узнать не удалось
+    sheet_id = extract_sheet_id(sheet_url)
+    if not sheet_id:
+        return None
+    try:
+        result = execute_with_backoff(get_thread_drive_service(credentials_file).files().get(
+            fileId=sheet_id, fields='modifiedTime', supportsAllDrives=True))
+        return result.get('modifiedTime')
+    except HttpError as error:
+        logging.warning(f"Failed to get modified time of {sheet_url}: {error}")
+        return None
+
+
 def get_sheet_data(service, sheet_id):
     try:
-        sheet_metadata = service.spreadsheets().get(spreadsheetId=sheet_id).execute()
+        sheet_metadata = execute_with_backoff(service.spreadsheets().get(spreadsheetId=sheet_id))
         sheets = sheet_metadata['sheets']
         return sheets
     except HttpError as error:
-        print(f'An error occurred: {error}')
+        logging.warning(f"Failed to get metadata of {sheet_id}: {error}")
         return None
 
 
+def get_sheet_titles(sheet_url, credentials_file, service_factory=None):
+    # Названия листов одним легким запросом: только sheets.properties.title, без данных ячеек
+    sheet_id = extract_sheet_id(sheet_url) if is_valid_google_sheet_url(sheet_url) else None
+    if not sheet_id:
+        logging.warning(f"Invalid Google Sheets URL: {sheet_url}")
+        return []
+    if service_factory is None:
+        service_factory = functools.partial(get_thread_service, credentials_file)
+    try:
+        metadata = execute_with_backoff(service_factory().spreadsheets().get(
+            spreadsheetId=sheet_id, fields='sheets.properties.title'))
+    except HttpError as error:
+        logging.warning(f"Failed to list sheets of {sheet_id}: {error}")
+        return []
+    return [sheet['properties']['title'] for sheet in metadata.get('sheets', [])]
+
+
 def get_sheet_values(service, sheet_id, sheet_name):
     try:
-        result = service.spreadsheets().values().get(spreadsheetId=sheet_id, range=sheet_name).execute()
+        result = execute_with_backoff(service.spreadsheets().values().get(spreadsheetId=sheet_id, range=sheet_name))
         values = result.get('values', [])
         return values
     except HttpError as error:
-        print(f'An error occurred: {error}')
+        logging.warning(f"Failed to get values of sheet {sheet_name}: {error}")
         return None
 
 
 def get_sheet_formatting(service, sheet_id, sheet_name):
     try:
-        result = service.spreadsheets().get(spreadsheetId=sheet_id, ranges=f'{sheet_name}!A:AZ',
-                                            fields="sheets(data(rowData(values(userEnteredFormat))))").execute()
+        result = execute_with_backoff(service.spreadsheets().get(
+            spreadsheetId=sheet_id, ranges=f'{sheet_name}!A:AZ',
+            fields="sheets(data(rowData(values(userEnteredFormat))))"))
         return result
     except HttpError as error:
-        print(f'An error occurred: {error}')
+        logging.warning(f"Failed to get formatting of sheet {sheet_name}: {error}")
+        return None
+
+
+def get_spreadsheet_grid(service, sheet_id):
+    # Значения и цвет фона всех листов одним запросом
+    try:
+        return execute_with_backoff(service.spreadsheets().get(
+            spreadsheetId=sheet_id, includeGridData=True,
+            fields="sheets(properties(title),data(rowData(values(formattedValue,userEnteredFormat(backgroundColor)))))"))
+    except HttpError as error:
+        logging.warning(f"Failed to get grid of {sheet_id}: {error}")
+        return None
+
+
+def get_sheet_grid(service, sheet_id, sheet_name):
+    # Значения и цвет фона одного листа одним запросом
+    quoted = "'" + sheet_name.replace("'", "''") + "'"
+    try:
+        return execute_with_backoff(service.spreadsheets().get(
+            spreadsheetId=sheet_id, ranges=quoted, includeGridData=True,
+            fields="sheets(data(rowData(values(formattedValue,userEnteredFormat(backgroundColor)))))"))
+    except HttpError as error:
+        logging.warning(f"Failed to read sheet {sheet_name}: {error}")
         return None
 
 
+def split_grid(sheet):
+    # Приводит данные листа к виду, который возвращают values().get и get_sheet_formatting
+    row_data = [row_data for data in sheet.get('data', []) for row_data in data.get('rowData', [])]
+    values = []
+    for row in row_data:
+        cells = [cell.get('formattedValue', '') for cell in row.get('values', [])]
+        while cells and cells[-1] == '':
+            cells.pop()
+        values.append(cells)
+    while values and not values[-1]:
+        values.pop()
+    formatting = {'sheets': [{'data': [{'rowData': row_data}]}]}
+    return values, formatting
+
+
 def is_colored(bg_color):
     return not (
             bg_color.get('red', 1) == 1 and
@@ -48,32 +161,47 @@ def is_colored(bg_color):
     )
 
 
-def parse_skills_data(values, formatting):
-    skills_data = []
+def colored_row(cells, dated, columns):
+    # bytearray на строку: 1 - ячейка окрашена и стоит под датой.
+    # Первые два столбца (навык и ссылка) не учитываются. Каждая ячейка под датой проверяется в цикле
+    flags = bytearray(columns)
+    for col_index in dated:
+        if col_index >= len(cells):
+            break
+        color = cells[col_index].get('userEnteredFormat', {}).get('backgroundColor')
+        if color and color != WHITE and is_colored(color):
+            flags[col_index] = 1
+    return flags
+
+
+def iter_skills_data(values, formatting):
+    # Генератор (skill, link, start_date, end_date): строки разбираются по одной, по мере чтения
+    try:
+        row_data = formatting['sheets'][0]['data'][0]['rowData']
+    except (IndexError, KeyError):
+        row_data = []
     headers = values[0]
+    header_dates = [header.split()[0] if header.split() else '' for header in headers]
+    dated = [index for index in range(2, len(headers)) if header_dates[index]]
+
     for row_index, row in enumerate(values[1:], start=1):
         skill = row[0] if len(row) > 0 else ''
         link = row[1] if len(row) > 1 else ''
-        start_date = None
-        end_date = None
-
-        for col_index in range(2, len(headers)):
-            try:
-                cell_format = formatting['sheets'][0]['data'][0]['rowData'][row_index]['values'][col_index][
-                    'userEnteredFormat']
-                if 'backgroundColor' in cell_format:
-                    bg_color = cell_format['backgroundColor']
-                    if is_colored(bg_color):
-                        if start_date is None:
-                            start_date = headers[col_index].split()[0]
-                        end_date = headers[col_index].split()[0]
-            except (IndexError, KeyError):
-                continue
-
-        if skill and link and start_date and end_date:
-            skills_data.append((skill, link, start_date, end_date))
+        if not (skill and link):
+            continue
 
-    return skills_data
+        cells = row_data[row_index].get('values', []) if row_index < len(row_data) else []
+        flags = colored_row(cells, dated, len(headers))
+        # Первый и последний окрашенный столбец - find/rfind по флагам строки
+        first = flags.find(1)
+        if first == -1:
+            continue
+        last = flags.rfind(1)
+        yield skill, link, header_dates[first], header_dates[last]
+
+
+def parse_skills_data(values, formatting):
+    return list(iter_skills_data(values, formatting))
 
 
 def extract_sheet_id(sheet_url):
@@ -85,34 +213,94 @@ def is_valid_google_sheet_url(url):
     return bool(re.match(r"https://docs\.google\.com/spreadsheets/d/[a-zA-Z0-9-_]+", url))
 
 
-def parse_google_sheet(sheet_url, credentials_file):
+def parse_sheet_tab(service_factory, sheet_id, sheet_name):
+    service = service_factory()
+    values = get_sheet_values(service, sheet_id, sheet_name)
+    if not values:
+        logging.warning(f"No values in sheet {sheet_name}")
+        return None
+    formatting = get_sheet_formatting(service, sheet_id, sheet_name)
+    if not formatting:
+        logging.warning(f"No formatting for sheet {sheet_name}")
+        return None
+    return parse_skills_data(values, formatting)
+
+
+def iter_sheet_skills(sheet_url, credentials_file, sheet_name, service_factory=None):
+    # Навыки одного листа генератором iter_skills_data (для сохранения курса после /addcourse);
+    # None, если лист прочитать не удалось
+    sheet_id = extract_sheet_id(sheet_url)
+    if not sheet_id:
+        return None
+    if service_factory is None:
+        service_factory = functools.partial(get_thread_service, credentials_file)
+    grid = get_sheet_grid(service_factory(), sheet_id, sheet_name)
+    if not grid or not grid.get('sheets'):
+        return None
+    values, formatting = split_grid(grid['sheets'][0])
+    if not values:
+        return None
+    return iter_skills_data(values, formatting)
+
+
+def parse_google_sheet(sheet_url, credentials_file, max_workers=MAX_WORKERS, progress=None, batched=True,
+                       service_factory=None, lazy=False):
+    # batched=True - все листы одним запросом spreadsheets.get, иначе 2 запроса на лист в max_workers потоков.
+    # progress(done, total) вызывается из рабочих потоков после каждого листа.
+    # service_factory() возвращает клиент Sheets для текущего потока (например, sheets_fake.FakeSheetsService)
     if not is_valid_google_sheet_url(sheet_url):
-        print("Некорректный Google Sheets URL.")
+        logging.warning(f"Invalid Google Sheets URL: {sheet_url}")
         return {}
 
     sheet_id = extract_sheet_id(sheet_url)
     if not sheet_id:
-        print("Failed to extract sheet ID из URL.")
+        logging.warning(f"Failed to extract sheet ID from {sheet_url}")
         return {}
 
-    service = authorize_google_sheets(credentials_file)
+    if service_factory is None:
+        service_factory = functools.partial(get_thread_service, credentials_file)
+    service = service_factory()
+    if batched:
+        return parse_spreadsheet_grid(service, sheet_id, progress, lazy)
+
     sheets = get_sheet_data(service, sheet_id)
+    if not sheets:
+        logging.warning(f"Failed to retrieve sheet list of {sheet_id}")
+        return {}
+
+    sheet_names = [sheet['properties']['title'] for sheet in sheets]
+    parsed = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(parse_sheet_tab, service_factory, sheet_id, sheet_name): sheet_name
+                   for sheet_name in sheet_names}
+        for done, future in enumerate(as_completed(futures), start=1):
+            skills = future.result()
+            if skills is not None:
+                parsed[futures[future]] = skills
+            if progress:
+                progress(done, len(sheet_names))
+
+    # Порядок курсов - как у листов в таблице
+    return {sheet_name: parsed[sheet_name] for sheet_name in sheet_names if sheet_name in parsed}
 
-    skills_data = {}
-    if sheets:
-        for sheet in sheets:
-            sheet_name = sheet['properties']['title']
-            values = get_sheet_values(service, sheet_id, sheet_name)
-            if values:
-                formatting = get_sheet_formatting(service, sheet_id, sheet_name)
-                if formatting:
-                    skills = parse_skills_data(values, formatting)
-                    skills_data[sheet_name] = skills
-                else:
-                    print(f"Failed to retrieve formatting information for sheet: {sheet_name}")
-            else:
-                print(f"Failed to retrieve values for sheet: {sheet_name}")
-    else:
-        print("Failed to retrieve sheet data.")
 
+def parse_spreadsheet_grid(service, sheet_id, progress=None, lazy=False):
+    # lazy=True - вместо списков навыков генераторы iter_skills_data, разбор идет при чтении
+    grid = get_spreadsheet_grid(service, sheet_id)
+    if not grid or not grid.get('sheets'):
+        logging.warning(f"Failed to retrieve sheet list of {sheet_id}")
+        return {}
+
+    skills_data = {}
+    sheets = grid['sheets']
+    for done, sheet in enumerate(sheets, start=1):
+        sheet_name = sheet['properties']['title']
+        values, formatting = split_grid(sheet)
+        if values:
+            parse = iter_skills_data if lazy else parse_skills_data
+            skills_data[sheet_name] = parse(values, formatting)
+        else:
+            logging.warning(f"No values in sheet {sheet_name}")
+        if progress:
+            progress(done, len(sheets))
     return skills_data
@@ -0,0 +1,133 @@
+import functools
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from db import Database
+
+# Методы Database, которые не профилируются: служебные, а не запросы бота
+SKIPPED_METHODS = {'close', 'transaction', 'run_batch', 'create_tables', 'migrate', 'schema_version', 'explain'}
+MAX_SAMPLES = 10000
+MAX_LOGGED_STATEMENTS = 10
+
+
+def database_methods():
+    return [name for name in dir(Database)
+            if not name.startswith('_') and name not in SKIPPED_METHODS and callable(getattr(Database, name))]
+
+
+def count_rows(result):
+    if result is None:
+        return 0
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, sqlite3.Row):
+        return 1
+    return 0
+
+
+def trace_into(stack, sql):
+    for statements in stack:
+        statements.append(sql)
+
+
+def percentile(samples, fraction):
+    return samples[int(fraction * (len(samples) - 1))] if samples else 0
+
+
+class MethodStats:
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.rows = 0
+        # Последние MAX_SAMPLES замеров для p50/p99
+        self.samples = deque(maxlen=MAX_SAMPLES)
+
+
+class QueryProfiler:
+    # Оборачивает методы экземпляров Database: время, число строк, медленные запросы с EXPLAIN QUERY PLAN.
+    # Один профайлер на все соединения AsyncDatabase (потоки пула и поток записи)
+    def __init__(self, slow_threshold=0.1):
+        self.slow_threshold = slow_threshold
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def attach(self, database):
+        for name in database_methods():
+            setattr(database, name, self._wrap(database, name, getattr(database, name)))
+        return database
+
+    def _wrap(self, database, name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            # Стек вызовов потока: SQL попадает в список каждого незавершенного вызова, поэтому вложенный
+            # вызов (метод вызывает другой метод) логирует свои запросы, а внешний - все, включая вложенные
+            stack = getattr(self._local, 'stack', None)
+            if stack is None:
+                stack = self._local.stack = []
+            statements = []
+            if not stack:
+                database.connection.set_trace_callback(functools.partial(trace_into, stack))
+            stack.append(statements)
+            start = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                stack.pop()
+                if not stack:
+                    database.connection.set_trace_callback(None)
+            self._record(name, elapsed, count_rows(result))
+            if elapsed >= self.slow_threshold:
+                self._log_slow(database, name, args, kwargs, elapsed, statements)
+            return result
+        return wrapper
+
+    def _record(self, name, elapsed, rows):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = MethodStats()
+            stats.calls += 1
+            stats.total += elapsed
+            stats.rows += rows
+            stats.samples.append(elapsed)
+
+    def _log_slow(self, database, name, args, kwargs, elapsed, statements):
+        lines = [f"Slow query {name} {elapsed * 1000:.1f} ms, args={args!r} kwargs={kwargs!r}"]
+        # Трассировка sqlite отдает SQL с уже подставленными параметрами
+        statements = [sql for sql in statements
+                      if sql.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'))]
+        for sql in statements[:MAX_LOGGED_STATEMENTS]:
+            lines.append(f"  {' '.join(sql.split())}")
+            try:
+                lines.extend(f"    {detail}" for detail in database.explain(sql))
+            except sqlite3.Error as e:
+                lines.append(f"    explain failed: {e}")
+        if len(statements) > MAX_LOGGED_STATEMENTS:
+            # executemany трассирует каждую строку отдельно
+            lines.append(f"  ... and {len(statements) - MAX_LOGGED_STATEMENTS} more statements")
+        logging.warning('\n'.join(lines))
+
+    def summary(self):
+        # [(метод, вызовов, всего сек, p50 сек, p99 сек, строк)], самые затратные первыми
+        with self._lock:
+            rows = []
+            for name, stats in self._stats.items():
+                samples = sorted(stats.samples)
+                rows.append((name, stats.calls, stats.total, percentile(samples, 0.5), percentile(samples, 0.99),
+                             stats.rows))
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def report(self):
+        lines = [f"{'method':<34}{'calls':>8}{'total ms':>11}{'p50 ms':>9}{'p99 ms':>9}{'rows':>9}"]
+        for name, calls, total, p50, p99, rows in self.summary():
+            lines.append(f"{name:<34}{calls:>8}{total * 1000:>11.1f}{p50 * 1000:>9.2f}{p99 * 1000:>9.2f}{rows:>9}")
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
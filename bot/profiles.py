@@ -0,0 +1,56 @@
+from collections import OrderedDict
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+MAX_PROFILES = 10000
+
+# Записи в базу, после которых профиль пользователя (первый аргумент) устарел
+INVALIDATING_METHODS = {'add_user', 'set_rules', 'set_nickname', 'set_signup'}
+
+
+class ProfileCache:
+    def __init__(self, db, max_size=MAX_PROFILES):
+        self.db = db
+        self.max_size = max_size
+        self._profiles = OrderedDict()
+        # Растет при каждой инвалидации: чтение, во время которого была запись, в кеш не попадает
+        self._version = 0
+        db.add_write_listener(self._on_write)
+
+    async def get(self, user_id):
+        if user_id in self._profiles:
+            self._profiles.move_to_end(user_id)
+            return self._profiles[user_id]
+        version = self._version
+        row = await self.db.get_profile(user_id)
+        profile = dict(row) if row else None
+        if version != self._version:
+            return profile
+        self._profiles[user_id] = profile
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+        return profile
+
+    def invalidate(self, user_id):
+        self._version += 1
+        self._profiles.pop(user_id, None)
+
+    def _on_write(self, name, args):
+        if name in INVALIDATING_METHODS and args:
+            self.invalidate(args[0])
+
+
+class ProfileMiddleware(BaseMiddleware):
+    # Профиль автора апдейта попадает в хендлер аргументом profile (None, если пользователя нет в базе)
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    async def on_process_message(self, message, data):
+        data['profile'] = await self.cache.get(message.from_user.id)
+
+    async def on_process_callback_query(self, callback_query, data):
+        data['profile'] = await self.cache.get(callback_query.from_user.id)
+
+    async def on_process_inline_query(self, inline_query, data):
+        data['profile'] = await self.cache.get(inline_query.from_user.id)
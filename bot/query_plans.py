@@ -0,0 +1,105 @@
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+import pytz
+
+from db import Database
+
+# Методы Database с примерными аргументами: по ним собираются реальные SQL-запросы
+SAMPLE_CALLS = [
+    ('user_exists', (1,)),
+    ('get_signup', (1,)),
+    ('get_rules', (1,)),
+    ('get_nickname', (1,)),
+    ('get_users', ()),
+    ('get_users', (10,)),
+    ('get_courses', ()),
+    ('get_all_courses', ()),
+    ('search_users', ('ник',)),
+    ('search_courses', ('курс', 1)),
+    ('search_courses', ('курс', None, 1)),
+    ('get_course_password', (1,)),
+    ('get_user_courses', (1,)),
+    ('get_user_courses_as_owner', (1,)),
+    ('get_user_enrollments', (1,)),
+    ('get_enrolled_users', (1,)),
+    ('get_students_in_course', (1,)),
+    ('get_all_users', ()),
+    ('get_current_week', (1, 1)),
+    ('get_skills_for_week', (1, 1)),
+    ('get_due_skills_digests', ()),
+    ('get_last_notification', (1, 1, '1_day')),
+    ('get_due_notifications', (datetime.now(pytz.timezone("Europe/Moscow")),)),
+    ('get_students_without_appointments', ()),
+    ('get_students_without_appointments', (1, 1)),
+    ('get_enrollment', (1,)),
+    ('get_user_appointments', (1,)),
+    ('get_appointment', (1,)),
+    ('get_appointment_schedule', ()),
+    ('get_homework_page', (1,)),
+    ('get_homework_page', (1, 1)),
+    ('get_homework_page', (1, None, 1)),
+    ('add_user', (1,)),
+    ('set_rules', (1, 0)),
+    ('enroll_user', (1, 1)),
+    ('set_week_override', (1, 1, None)),
+    ('update_notification_log', (1, 1, '1_day', datetime.now())),
+    ('enqueue_notifications', ([(1, 1, '1_day', 'text')], datetime.now())),
+    ('get_outbox_batch', (0,)),
+    ('complete_outbox', ([1], [(2, 'error', 0)], [(3, 'error')])),
+    ('acquire_lease', ('scheduler', 'host', 30)),
+    ('submit_homework', (1, 1, 'link')),
+    ('record_skills_notifications', ([(1, 1, 1)],))
+]
+
+STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def collect_query_plans(db_file):
+    # Запросы выполняются на копии базы в памяти с примененными миграциями, исходный файл не меняется
+    if not os.path.exists(db_file):
+        raise FileNotFoundError(db_file)
+    database = Database(':memory:', create=False)
+    source = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    source.backup(database.connection)
+    source.close()
+    database.create_tables()
+
+    # [(метод, аргументы, запросы)]: у одного метода бывает несколько вариантов запроса (курсоры, фильтры)
+    plans = []
+    for name, args in SAMPLE_CALLS:
+        statements = []
+        database.connection.set_trace_callback(statements.append)
+        try:
+            getattr(database, name)(*args)
+        except Exception as e:
+            # Например, в базе нет строк, на которые рассчитаны примерные аргументы
+            plans.append((name, args, [(None, [f"error: {type(e).__name__}: {e}"])]))
+            continue
+        finally:
+            database.connection.set_trace_callback(None)
+        plans.append((name, args, [(sql, database.explain(sql)) for sql in statements
+                                   if sql.lstrip().upper().startswith(STATEMENTS)]))
+    version = database.schema_version()
+    database.close()
+    return version, plans
+
+
+def report_query_plans(db_file):
+    version, plans = collect_query_plans(db_file)
+    print(f"Schema version: {version}")
+    for name, args, queries in plans:
+        print(f"\n{name}({', '.join(map(repr, args))})")
+        for sql, plan in queries:
+            for detail in plan:
+                marker = '!' if detail.startswith('SCAN') else ' '
+                print(f"  {marker} {detail}")
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'database.db'
+    if not os.path.exists(path):
+        sys.exit(f"Database file not found: {path}")
+    report_query_plans(path)
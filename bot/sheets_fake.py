@@ -0,0 +1,130 @@
+import json
+import random
+import re
+import threading
+from datetime import date, timedelta
+
+# Локальная замена service.spreadsheets() для parsering без обращения к Google API.
+# Таблица описывается словарем {название листа: {'values': [[...], ...], 'colored': [[строка, столбец], ...]}}
+
+COLORED = {'backgroundColor': {'red': 0.8, 'green': 0.9, 'blue': 1}}
+WHITE = {'backgroundColor': {'red': 1, 'green': 1, 'blue': 1}}
+
+
+def generate_spreadsheet(tabs=5, rows=1000, date_columns=100, fill=0.9, seed=0):
+    # Лист: заголовок "Навык | Ссылка | даты недель", у каждого навыка окрашен отрезок недель
+    rng = random.Random(seed)
+    start = date(2024, 9, 2)
+    headers = ['Навык', 'Ссылка'] + [(start + timedelta(weeks=week)).strftime('%d.%m.%Y пн')
+                                     for week in range(date_columns)]
+    spreadsheet = {}
+    for tab in range(tabs):
+        values = [headers]
+        colored = []
+        for row in range(1, rows + 1):
+            values.append([f'Навык {tab}-{row}', f'https://example.com/{tab}/{row}'])
+            if rng.random() < fill:
+                first = rng.randrange(date_columns)
+                last = min(date_columns - 1, first + rng.randrange(4))
+                colored.extend([row, column + 2] for column in range(first, last + 1))
+        spreadsheet[f'Курс {tab + 1}'] = {'values': values, 'colored': colored}
+    return spreadsheet
+
+
+def load_fixture(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter.upper()) - ord('A') + 1
+    return index - 1
+
+
+class FakeRequest:
+    def __init__(self, service, response):
+        self.service = service
+        self.response = response
+
+    def execute(self, num_retries=0):
+        with self.service.lock:
+            self.service.calls += 1
+        return self.response()
+
+
+class FakeValues:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, spreadsheetId, range):
+        return FakeRequest(self.service, lambda: {'values': self.service.tab(range)['values']})
+
+
+class FakeSpreadsheets:
+    def __init__(self, service):
+        self.service = service
+
+    def values(self):
+        return FakeValues(self.service)
+
+    def get(self, spreadsheetId, ranges=None, fields=None, includeGridData=False):
+        return FakeRequest(self.service, lambda: self.service.spreadsheet(ranges, includeGridData))
+
+
+class FakeSheetsService:
+    def __init__(self, spreadsheet):
+        self.data = spreadsheet
+        self.lock = threading.Lock()
+        self.calls = 0
+        self._colored = {name: {tuple(cell) for cell in tab['colored']} for name, tab in spreadsheet.items()}
+        # Ответы строятся один раз, чтобы бенчмарк мерил парсер, а не заглушку
+        self._row_data = {}
+
+    def __call__(self):
+        # Можно передавать сам сервис как service_factory
+        return self
+
+    def spreadsheets(self):
+        return FakeSpreadsheets(self)
+
+    def tab(self, sheet_range):
+        return self.data[sheet_range.split('!')[0].strip("'")]
+
+    def row_data(self, name, values_included, last_column=None):
+        key = (name, values_included, last_column)
+        if key not in self._row_data:
+            self._row_data[key] = self._build_row_data(name, values_included, last_column)
+        return self._row_data[key]
+
+    def _build_row_data(self, name, values_included, last_column):
+        tab = self.data[name]
+        colored = self._colored[name]
+        width = max(len(row) for row in tab['values'])
+        if last_column is not None:
+            width = min(width, last_column + 1)
+        rows = []
+        for row_index, row in enumerate(tab['values']):
+            cells = []
+            for col_index in range(width):
+                cell = {'userEnteredFormat': COLORED if (row_index, col_index) in colored else WHITE}
+                if values_included and col_index < len(row):
+                    cell['formattedValue'] = row[col_index]
+                cells.append(cell)
+            rows.append({'values': cells})
+        return rows
+
+    def spreadsheet(self, ranges, include_grid_data):
+        if ranges and '!' not in ranges:
+            # Весь лист со значениями
+            name = ranges.strip("'").replace("''", "'")
+            return {'sheets': [{'data': [{'rowData': self.row_data(name, True)}]}]}
+        if ranges:
+            name, cells = ranges.split('!')
+            last_column = column_index(re.sub(r'\d', '', cells.split(':')[1]))
+            return {'sheets': [{'data': [{'rowData': self.row_data(name.strip("'"), False, last_column)}]}]}
+        if include_grid_data:
+            return {'sheets': [{'properties': {'title': name}, 'data': [{'rowData': self.row_data(name, True)}]}
+                               for name in self.data]}
+        return {'sheets': [{'properties': {'title': name}} for name in self.data]}
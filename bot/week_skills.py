@@ -0,0 +1,34 @@
+# Записи в базу, после которых навыки курса (первый аргумент) по неделям устарели
+INVALIDATING_METHODS = {'add_skills', 'sync_skills', 'rebuild_course_weeks'}
+
+
+class WeekSkillsCache:
+    # Навыки курса по неделям из course_week_skills; держатся в памяти до следующего импорта таблицы курса.
+    # enabled=False - всегда читать из базы (таблицу может импортировать другой экземпляр бота)
+    def __init__(self, db, enabled=True):
+        self.db = db
+        self.enabled = enabled
+        self._courses = {}
+        # Растет при каждой инвалидации: чтение, во время которого была запись, в кеш не попадает
+        self._version = 0
+        db.add_write_listener(self._on_write)
+
+    async def get(self, course_id, week):
+        if not self.enabled:
+            return [dict(row) for row in await self.db.get_skills_for_week(course_id, week)]
+        weeks = self._courses.get(course_id, {})
+        if week in weeks:
+            return weeks[week]
+        version = self._version
+        skills = [dict(row) for row in await self.db.get_skills_for_week(course_id, week)]
+        if version == self._version:
+            self._courses.setdefault(course_id, {})[week] = skills
+        return skills
+
+    def invalidate(self, course_id):
+        self._version += 1
+        self._courses.pop(course_id, None)
+
+    def _on_write(self, name, args):
+        if name in INVALIDATING_METHODS and args:
+            self.invalidate(args[0])